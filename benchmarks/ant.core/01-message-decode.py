@@ -0,0 +1,63 @@
+"""
+Decode a synthetic 4 Hz x 8-channel broadcast stream (one hour worth of
+frames) and read a couple of fields from every message.
+
+Run against an older tree to get "before" numbers; the memoryview pass is
+skipped where Message.decode() does not take an offset.
+
+"""
+
+import time
+
+from ant.core import message
+
+CHANNELS = 8
+RATE = 4
+SECONDS = 3600
+FRAME_SIZE = 12  # 1 channel byte + 7 data bytes + 4 framing bytes
+
+
+def build_stream():
+    frames = []
+    for i in range(RATE * SECONDS):
+        for channel in range(CHANNELS):
+            data = chr(i % 256) * 7
+            msg = message.ChannelBroadcastDataMessage(number=channel,
+                                                      data=data)
+            frames.append(msg.encode())
+    return ''.join(frames)
+
+
+def decode_sliced(stream):
+    hf = message.Message()
+    offset = 0
+    while offset < len(stream):
+        msg = hf.getHandler(stream[offset:offset + FRAME_SIZE])
+        msg.getChannelNumber()
+        msg.payload[-1]
+        offset += msg.getSize()
+
+
+def decode_memoryview(stream):
+    hf = message.Message()
+    view = memoryview(stream)
+    offset = 0
+    while offset < len(stream):
+        msg = hf.getHandler(view, offset)
+        msg.getChannelNumber()
+        msg.payload[-1]
+        offset += msg.getSize()
+
+
+def run(title, func, stream):
+    start = time.time()
+    func(stream)
+    elapsed = time.time() - start
+    frames = len(stream) / FRAME_SIZE
+    print '{0:<12} {1:>8} frames {2:>8.3f} s {3:>10.0f} frames/s'.format(
+        title, frames, elapsed, frames / elapsed)
+
+
+stream = build_stream()
+run('sliced', decode_sliced, stream)
+run('memoryview', decode_memoryview, stream)
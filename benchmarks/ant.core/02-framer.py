@@ -0,0 +1,61 @@
+"""
+Frame a 10 MB synthetic capture fed in chunks of various sizes, using the
+string-slicing ProcessBuffer() loop the pump used to run and the
+incremental Framer.
+
+"""
+
+import time
+
+from ant.core import event
+from ant.core import message
+
+SIZE = 10 * 1024 * 1024
+CHUNKS = (20, 4096, 65536)
+
+
+def build_capture():
+    frames = []
+    total = 0
+    i = 0
+    while total < SIZE:
+        msg = message.ChannelBroadcastDataMessage(number=i % 8,
+                                                  data=chr(i % 256) * 7)
+        raw = msg.encode()
+        frames.append(raw)
+        total += len(raw)
+        i += 1
+    return ''.join(frames), i
+
+
+def process_buffer(capture, chunk):
+    buffer_ = ''
+    count = 0
+    for i in xrange(0, len(capture), chunk):
+        buffer_ += capture[i:i + chunk]
+        buffer_, messages = event.ProcessBuffer(buffer_)
+        count += len(messages)
+    return count
+
+
+def framer(capture, chunk):
+    framer = event.Framer()
+    count = 0
+    for i in xrange(0, len(capture), chunk):
+        count += len(framer.feed(capture[i:i + chunk]))
+    return count
+
+
+def run(title, func, capture, chunk, expected):
+    start = time.time()
+    count = func(capture, chunk)
+    elapsed = time.time() - start
+    assert count == expected
+    print '{0:<14} chunk {1:>5} {2:>8.3f} s {3:>8.2f} MB/s'.format(
+        title, chunk, elapsed, len(capture) / elapsed / 1024 / 1024)
+
+
+capture, frames = build_capture()
+for chunk in CHUNKS:
+    run('ProcessBuffer', process_buffer, capture, chunk, frames)
+    run('Framer', framer, capture, chunk, frames)
@@ -0,0 +1,41 @@
+"""
+Dispatch broadcast data through an EventMachine serving a node with
+eight channels, each with one listener, and report the cost per message.
+
+"""
+
+import time
+
+from ant.core import driver
+from ant.core import event
+from ant.core import message
+from ant.core import node
+
+MESSAGES = 200000
+CHANNELS = 8
+
+
+class Listener(event.EventCallback):
+    count = 0
+
+    def process(self, msg):
+        self.count += 1
+
+
+node_ = node.Node(driver.Driver('/dev/null'))
+listeners = []
+for i in range(CHANNELS):
+    listeners.append(Listener())
+    node.Channel(node_, i).registerCallback(listeners[i])
+
+messages = [message.ChannelBroadcastDataMessage(number=i % CHANNELS)
+            for i in range(MESSAGES)]
+
+start = time.time()
+for i in xrange(0, MESSAGES, 100):
+    node_.evm.dispatch(messages[i:i + 100])
+elapsed = time.time() - start
+
+assert sum([l.count for l in listeners]) == MESSAGES
+print '{0} channels: {1:.3f} s, {2:.2f} us/message'.format(
+    CHANNELS, elapsed, elapsed / MESSAGES * 1000000)
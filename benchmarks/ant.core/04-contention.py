@@ -0,0 +1,92 @@
+"""
+Run 1 to 8 simulated sticks in one process, each with its own
+EventMachine and a thread sending commands and waiting for their acks,
+and report how total command throughput scales with the number of sticks.
+
+A simulated stick answers every command with an ack, and its reads block
+for up to 10 ms waiting for the bytes asked for, like the USB1 serial
+port's read timeout.
+
+"""
+
+import os
+import Queue
+import sys
+import threading
+import time
+
+from ant.core import driver
+from ant.core import event
+from ant.core import message
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                os.pardir, 'src', 'ant', 'core', 'tests'))
+from fakes import QueueDriver
+
+DURATION = 2
+STICKS = (1, 2, 4, 8)
+
+
+class SimulatedStick(QueueDriver):
+    def _wait(self, timeout):
+        return driver.Driver._wait(self, timeout)
+
+    def _available(self):
+        return 0
+
+    def _read(self, count):
+        # Like a serial port: return once count bytes are in or the read
+        # timeout expires, whichever comes first.
+        data = ''
+        deadline = time.time() + 0.01
+        while len(data) < count and time.time() < deadline:
+            try:
+                data += self.queue.get_nowait()
+            except Queue.Empty:
+                time.sleep(0.001)
+        return data
+
+    def reply(self, msg):
+        return [message.ChannelEventMessage(number=msg.getChannelNumber(),
+                                            message_id=msg.getType())]
+
+
+def send(evm, deadline, counts):
+    count = 0
+    while time.time() < deadline:
+        evm.sendCommand(message.ChannelOpenMessage()).wait()
+        count += 1
+    counts.append(count)
+
+
+def run(sticks):
+    machines = []
+    for i in range(sticks):
+        stick = SimulatedStick()
+        stick.open()
+        evm = event.EventMachine(stick)
+        evm.start()
+        machines.append(evm)
+
+    counts = []
+    deadline = time.time() + DURATION
+    threads = [threading.Thread(target=send, args=(evm, deadline, counts))
+               for evm in machines]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for evm in machines:
+        evm.stop()
+        evm.driver.close()
+    return sum(counts) / float(DURATION)
+
+
+single = None
+for sticks in STICKS:
+    rate = run(sticks)
+    if single is None:
+        single = rate
+    print '{0} sticks: {1:>8.1f} commands/s {2:>5.2f}x'.format(
+        sticks, rate, rate / single)
@@ -0,0 +1,76 @@
+"""
+Pump broadcast traffic through a USB1Driver opened on a pseudo-terminal,
+reading fixed 20-byte chunks (max_chunk=20, what the pump used to do) and
+reading whatever is pending in one go, and report bytes/s and pump
+iterations/s.
+
+Two cases: writing 1 MB as fast as the pty takes it, and a steady
+115200 baud stream (the USB1 stick's line rate) for a few seconds.
+
+"""
+
+import os
+import threading
+import time
+import tty
+
+from ant.core import driver
+from ant.core import event
+from ant.core import message
+
+BULK = 1024 * 1024
+STREAM_SECONDS = 3
+LINE_RATE = 115200 / 10
+
+
+def capture(size):
+    frames = []
+    total = 0
+    i = 0
+    while total < size:
+        raw = message.ChannelBroadcastDataMessage(number=i % 8).encode()
+        frames.append(raw)
+        total += len(raw)
+        i += 1
+    return ''.join(frames), i
+
+
+def feed(master, data, step, delay):
+    for i in xrange(0, len(data), step):
+        os.write(master, data[i:i + step])
+        if delay:
+            time.sleep(delay)
+
+
+def run(max_chunk, size, step, delay):
+    master, slave = os.openpty()
+    tty.setraw(master)
+    stick = driver.USB1Driver(os.ttyname(slave), max_chunk=max_chunk)
+    stick.open()
+    evm = event.EventMachine(stick)
+    data, frames = capture(size)
+    feeder = threading.Thread(target=feed, args=(master, data, step, delay))
+
+    iterations = received = 0
+    start = time.time()
+    feeder.start()
+    while received < frames:
+        received += len(evm.pumpOnce(event.PUMP_TIMEOUT))
+        iterations += 1
+    elapsed = time.time() - start
+
+    feeder.join()
+    stick.close()
+    os.close(master)
+    os.close(slave)
+    return len(data) / elapsed, iterations / elapsed
+
+
+cases = (('bulk', BULK, 4096, 0),
+         ('stream', LINE_RATE * STREAM_SECONDS, LINE_RATE / 100, 0.01))
+for title, size, step, delay in cases:
+    for label, max_chunk in (('fixed 20', 20),
+                             ('adaptive', driver.USB1_MAX_CHUNK)):
+        rate, iterations = run(max_chunk, size, step, delay)
+        print '{0:<6} {1:<9} {2:>8.1f} KB/s {3:>9.1f} iterations/s'.format(
+            title, label, rate / 1024, iterations)
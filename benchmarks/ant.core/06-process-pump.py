@@ -0,0 +1,103 @@
+"""
+Receive timing with the main process busy: a separate process writes a
+timestamped broadcast frame every 2 ms into a pseudo-terminal, while four
+threads in this process burn CPU. Compare a USB1Driver pumped by a thread
+in this process against the same driver wrapped in a ProcessDriver, which
+reads and frames in a child process.
+
+"backlog" is how many bytes sat unread in the port each time a frame was
+written (what a real UART would have to buffer, or overrun); "latency" is
+from writing a frame to its dispatch in this process.
+
+"""
+
+import multiprocessing
+import fcntl
+import os
+import struct
+import termios
+import threading
+import time
+import tty
+
+from ant.core import driver
+from ant.core import event
+from ant.core import message
+from ant.core import process
+
+FRAMES = 1500
+INTERVAL = 0.002
+BUSY_THREADS = 4
+
+
+def feed(master, slave, backlog):
+    for i in xrange(FRAMES):
+        unread = fcntl.ioctl(slave, termios.FIONREAD, '\x00' * 4)
+        backlog[i] = struct.unpack('i', unread)[0]
+        msg = message.ChannelBroadcastDataMessage(
+            data=struct.pack('<d', time.time()))
+        os.write(master, msg.encode())
+        time.sleep(INTERVAL)
+
+
+def busy(stop):
+    while not stop:
+        sum(xrange(1000))
+
+
+class Latency(event.EventCallback):
+    def __init__(self):
+        self.samples = []
+
+    def process(self, msg):
+        if isinstance(msg, message.ChannelBroadcastDataMessage):
+            sent = struct.unpack('<d', msg.getPayload()[1:9])[0]
+            self.samples.append(time.time() - sent)
+
+
+def run(wrap):
+    master, slave = os.openpty()
+    tty.setraw(master)
+    stick = wrap(driver.USB1Driver(os.ttyname(slave)))
+    stick.open()
+    evm = event.EventMachine(stick)
+    latency = Latency()
+    evm.registerCallback(latency)
+    evm.start()
+
+    stop = []
+    threads = [threading.Thread(target=busy, args=(stop,))
+               for i in range(BUSY_THREADS)]
+    for thread in threads:
+        thread.start()
+    backlog = multiprocessing.Array('i', FRAMES, lock=False)
+    feeder = multiprocessing.Process(target=feed,
+                                     args=(master, slave, backlog))
+    feeder.start()
+    feeder.join()
+    time.sleep(0.5)
+    stop.append(True)
+    for thread in threads:
+        thread.join()
+
+    evm.stop()
+    stick.close()
+    os.close(master)
+    os.close(slave)
+    return sorted(backlog), sorted(latency.samples)
+
+
+def quantile(samples, q):
+    return samples[min(int(len(samples) * q), len(samples) - 1)]
+
+
+def report(title, backlog, latency):
+    print '{0:<8} backlog p99 {1:>4} B max {2:>4} B   latency p50 ' \
+          '{3:>5.2f} ms p99 {4:>5.2f} ms max {5:>5.2f} ms'.format(
+          title, quantile(backlog, 0.99), backlog[-1],
+          quantile(latency, 0.5) * 1000, quantile(latency, 0.99) * 1000,
+          latency[-1] * 1000)
+
+
+report('thread', *run(lambda stick: stick))
+report('process', *run(process.ProcessDriver))
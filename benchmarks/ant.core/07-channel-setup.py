@@ -0,0 +1,70 @@
+"""
+Bring up all eight channels of a simulated stick, one blocking call per
+command (assign, setID, setSearchTimeout, setPeriod, setFrequency, open)
+and with Node.configureChannels().
+
+The simulated stick answers each write after a 4 ms USB round trip and
+takes 0.2 ms to process each command in it.
+
+"""
+
+import os
+import sys
+import time
+
+from ant.core import message
+from ant.core import node
+from ant.core.constants import *
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                os.pardir, 'src', 'ant', 'core', 'tests'))
+from fakes import QueueDriver
+
+LATENCY = 0.004
+PROCESSING = 0.0002
+
+
+class SimulatedStick(QueueDriver):
+    def __init__(self):
+        QueueDriver.__init__(self, latency=LATENCY)
+
+    def reply(self, msg):
+        time.sleep(PROCESSING)
+        if isinstance(msg, message.SystemResetMessage):
+            return [message.StartupMessage()]
+        if isinstance(msg, message.ChannelRequestMessage):
+            return [message.CapabilitiesMessage(8, 3)]
+        return [message.ChannelEventMessage(number=msg.payload[0],
+                                            message_id=msg.getType())]
+
+
+def sequential(node_):
+    for i in range(8):
+        channel = node_.getFreeChannel()
+        channel.assign(node_.networks[0].name, CHANNEL_TYPE_TWOWAY_RECEIVE)
+        channel.setID(120, 0, 0)
+        channel.setSearchTimeout(TIMEOUT_NEVER)
+        channel.setPeriod(8070)
+        channel.setFrequency(57)
+        channel.open()
+
+
+def pipelined(node_):
+    config = dict(net_key=node_.networks[0].name,
+                  ch_type=CHANNEL_TYPE_TWOWAY_RECEIVE, device=(120, 0, 0),
+                  search_timeout=TIMEOUT_NEVER, period=8070, frequency=57)
+    node_.configureChannels([config] * 8)
+
+
+def run(title, func):
+    node_ = node.Node(SimulatedStick())
+    node_.start()
+    start = time.time()
+    func(node_)
+    elapsed = time.time() - start
+    node_.stop(reset=False)
+    print '{0:<10} {1:>8.1f} ms'.format(title, elapsed * 1000)
+
+
+run('sequential', sequential)
+run('pipelined', pipelined)
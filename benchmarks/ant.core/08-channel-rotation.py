@@ -0,0 +1,93 @@
+"""
+Serve 32 sensors from the eight channels of a simulated stick with
+ChannelScheduler, and report how old each sensor's data gets.
+
+The simulated stick answers each write after a 4 ms USB round trip; open
+channels receive a broadcast every 250 ms (period 8192).
+
+"""
+
+import os
+import sys
+import threading
+import time
+
+from ant.core import message
+from ant.core import node
+from ant.core import scheduler
+from ant.core.constants import *
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                os.pardir, 'src', 'ant', 'core', 'tests'))
+from fakes import QueueDriver
+
+LATENCY = 0.004
+SENSORS = 32
+DURATION = 10.0
+
+
+class SimulatedStick(QueueDriver):
+    def __init__(self):
+        QueueDriver.__init__(self, latency=LATENCY)
+        self.open_channels = {}  # number: time of the next broadcast
+        self.lock = threading.Lock()
+        self.running = True
+        worker = threading.Thread(target=self.broadcast)
+        worker.setDaemon(True)
+        worker.start()
+
+    def _close(self):
+        self.running = False
+
+    def broadcast(self):
+        while True:
+            time.sleep(0.005)
+            if not self.running:
+                break
+            now = time.time()
+            self.lock.acquire()
+            for number, due in self.open_channels.items():
+                if now >= due:
+                    self.open_channels[number] = due + 0.25
+                    msg = message.ChannelBroadcastDataMessage(number=number)
+                    self.queue.put(msg.encode())
+            self.lock.release()
+
+    def reply(self, msg):
+        if isinstance(msg, message.SystemResetMessage):
+            return [message.StartupMessage()]
+        if isinstance(msg, message.ChannelRequestMessage):
+            return [message.CapabilitiesMessage(8, 3)]
+
+        number = msg.payload[0]
+        replies = [message.ChannelEventMessage(number=number,
+                                               message_id=msg.getType())]
+        self.lock.acquire()
+        if isinstance(msg, message.ChannelOpenMessage):
+            self.open_channels[number] = time.time() + 0.25
+        elif isinstance(msg, message.ChannelCloseMessage):
+            del self.open_channels[number]
+            replies.append(message.ChannelEventMessage(
+                number=number, message_id=MESSAGE_RF_EVENT,
+                message_code=EVENT_CHANNEL_CLOSED))
+        self.lock.release()
+        return replies
+
+
+node_ = node.Node(SimulatedStick())
+node_.start()
+rotation = scheduler.ChannelScheduler(node_, node_.networks[0].name)
+for number in range(SENSORS):
+    rotation.add(scheduler.Sensor(120, number, period=8192))
+rotation.start()
+time.sleep(DURATION)
+rotation.stop()
+node_.stop(reset=False)
+
+report = rotation.report()
+latencies = [r[3] for r in report if r[3] is not None]
+print 'sensors served  {0:>5} / {1}'.format(
+    len([r for r in report if r[1]]), SENSORS)
+print 'updates         {0:>5}'.format(sum(r[1] for r in report))
+print 'mean latency    {0:>8.3f} s'.format(sum(latencies) / len(latencies))
+print 'max latency     {0:>8.3f} s'.format(max(r[4] for r in report))
@@ -0,0 +1,46 @@
+"""
+Read back a capture of one million 13-byte reads with LogReader, in a
+child process, and report how long it took and the child's peak memory.
+
+"""
+
+import os
+import resource
+import time
+
+from ant.core import log
+from ant.core import message
+
+FILENAME = '/tmp/python-ant.benchmark.ant'
+EVENTS = 1000000
+
+
+def write_capture():
+    writer = log.LogWriter(FILENAME)
+    raw = message.ChannelBroadcastDataMessage(data='\x00' * 8).encode()
+    for i in xrange(EVENTS):
+        writer.logRead(raw)
+    writer.close()
+
+
+def read_capture():
+    reader = log.LogReader(FILENAME)
+    count = 0
+    for ev in reader:
+        count += 1
+    assert count == EVENTS
+
+
+write_capture()
+print 'capture     {0:>8.1f} MB'.format(os.path.getsize(FILENAME) / 1e6)
+
+pid = os.fork()
+if pid == 0:
+    start = time.time()
+    read_capture()
+    print 'read        {0:>8.2f} s'.format(time.time() - start)
+    os._exit(0)
+os.waitpid(pid, 0)
+peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+print 'peak memory {0:>8.1f} MB'.format(peak / 1024.0)
+os.remove(FILENAME)
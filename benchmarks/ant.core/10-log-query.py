@@ -0,0 +1,69 @@
+"""
+Find one minute of data in a capture spanning a day (one million reads,
+one event every ~86 ms), by scanning the whole log and with the sidecar
+index. Also times writing the capture with and without the index.
+
+"""
+
+import os
+import time
+
+from ant.core import log
+from ant.core import message
+
+FILENAME = '/tmp/python-ant.benchmark.ant'
+EVENTS = 1000000
+DAY = 24 * 3600
+MINUTE = (12 * 3600, 12 * 3600 + 59)
+
+
+class Clock(object):
+    now = 0
+
+    def time(self):
+        return self.now
+
+
+def write_capture(**kwargs):
+    clock = Clock()
+    log.time = clock
+    writer = log.LogWriter(FILENAME, **kwargs)
+    for i in xrange(EVENTS):
+        clock.now = i * DAY // EVENTS
+        raw = message.ChannelBroadcastDataMessage(number=i % 8,
+                                                  data='\x00' * 8).encode()
+        writer.logRead(raw)
+    writer.close()
+
+
+def scan():
+    found = 0
+    for ev in log.LogReader(FILENAME):
+        if MINUTE[0] <= ev[1] <= MINUTE[1]:
+            found += 1
+    return found
+
+
+def query():
+    reader = log.LogReader(FILENAME)
+    return len(list(reader.query(*MINUTE)))
+
+
+def run(title, func):
+    start = time.time()
+    result = func()
+    print '{0:<16} {1:>8.3f} s'.format(title, time.time() - start)
+    return result
+
+
+run('write', write_capture)
+run('write + index', lambda: write_capture(index=True))
+log.time = time
+
+found = run('scan', scan)
+assert run('query', query) == found
+os.remove(FILENAME + log.INDEX_SUFFIX)
+run('BuildIndex', lambda: log.BuildIndex(FILENAME))
+os.remove(FILENAME + log.INDEX_SUFFIX)
+print '{0} events in the minute'.format(found)
+os.remove(FILENAME)
@@ -21,7 +21,7 @@ NETKEY = '\xB9\xA5\x21\xFB\xBD\x72\xC3\x45'
 class HRMListener(event.EventCallback):
     def process(self, msg):
         if isinstance(msg, message.ChannelBroadcastDataMessage):
-            print 'Heart Rate:', ord(msg.payload[-1])
+            print 'Heart Rate:', msg.payload[-1]
 
 # Initialize
 stick = driver.USB1Driver(SERIAL, log=LOG, debug=DEBUG)
@@ -32,9 +32,7 @@ evm.registerCallback(MyCallback())
 evm.start()
 
 # Reset
-msg = SystemResetMessage()
-stick.write(msg.encode())
-time.sleep(1)
+evm.reset()
 
 # Set network key
 msg = NetworkKeyMessage(key=NETKEY)
@@ -82,9 +80,7 @@ print "Listening for ANT events (120 seconds)..."
 time.sleep(120)
 
 # Shutdown
-msg = SystemResetMessage()
-stick.write(msg.encode())
-time.sleep(1)
+evm.reset()
 
 evm.stop()
 stick.close()
@@ -34,9 +34,7 @@ evm.registerCallback(MyCallback())
 evm.start()
 
 # Reset
-msg = SystemResetMessage()
-stick.write(msg.encode())
-time.sleep(1)
+evm.reset()
 
 # Set network key
 msg = NetworkKeyMessage(key=NETKEY)
@@ -84,9 +82,7 @@ print "Listening for ANT events (120 seconds)..."
 time.sleep(120)
 
 # Shutdown
-msg = SystemResetMessage()
-stick.write(msg.encode())
-time.sleep(1)
+evm.reset()
 
 evm.stop()
 stick.close()
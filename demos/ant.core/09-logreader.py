@@ -16,8 +16,7 @@ if len(sys.argv) != 2:
 
 lr = log.LogReader(sys.argv[1])
 
-event = lr.read()
-while (event != None):
+for event in lr:
     if event[0] == log.EVENT_OPEN:
         title = 'EVENT_OPEN'
     elif event[0] == log.EVENT_CLOSE:
@@ -39,4 +38,3 @@ while (event != None):
             print '%04X' % line, ' '.join(hex_data)
 
     print ''
-    event = lr.read()
@@ -53,6 +53,7 @@ MESSAGE_CHANNEL_BURST_DATA = 0x50
 
 # Channel event messages
 MESSAGE_CHANNEL_EVENT = 0x40
+MESSAGE_RF_EVENT = 0x01  # Message ID of channel events not answering a command
 
 # Requested response messages
 MESSAGE_CHANNEL_STATUS = 0x52
@@ -120,4 +121,10 @@ CAPABILITIES_SCAN_MODE_ENABLED = 0x04
 CAPABILITIES_PROX_SEARCH_ENABLED = 0x10
 CAPABILITIES_EXT_ASSIGN_ENABLED = 0x20
 CAPABILITIES_FS_ANTFS_ENABLED = 0x40
+STARTUP_POWER_ON_RESET = 0x00
+STARTUP_HARDWARE_RESET_LINE = 0x01
+STARTUP_WATCHDOG_RESET = 0x02
+STARTUP_COMMAND_RESET = 0x20
+STARTUP_SYNCHRONOUS_RESET = 0x40
+STARTUP_SUSPEND_RESET = 0x80
 TIMEOUT_NEVER = 0xFF
@@ -23,7 +23,9 @@
 #
 ##############################################################################
 
+import select
 import thread
+import time
 
 # USB1 driver uses a USB<->Serial bridge
 import serial
@@ -32,18 +34,32 @@ import usb.core
 import usb.util
 
 from ant.core.exceptions import DriverError
+from ant.core.message import Message
 
 from array import *
 
+# Most USB1Driver reads at once, however much the port has pending.
+USB1_MAX_CHUNK = 4096
+# Size of the USB2 stick's bulk endpoint packets.
+USB2_PACKET_SIZE = 64
+
 
 class Driver(object):
-    _lock = thread.allocate_lock()
+    # How much the pump reads when available() can't tell; None leaves it
+    # to the pump.
+    read_size = None
 
     def __init__(self, device, log=None, debug=False):
         self.device = device
         self.debug = debug
         self.log = log
         self.is_open = False
+        # Reads and writes have their own locks so a write never waits
+        # behind a read blocked on the device; _lock guards the open state
+        # and the log, and open()/close() take all three.
+        self._lock = thread.allocate_lock()
+        self._read_lock = thread.allocate_lock()
+        self._write_lock = thread.allocate_lock()
 
     def isOpen(self):
         self._lock.acquire()
@@ -52,7 +68,7 @@ class Driver(object):
         return io
 
     def open(self):
-        self._lock.acquire()
+        self._acquireAll()
 
         try:
             if self.is_open:
@@ -63,10 +79,10 @@ class Driver(object):
             if self.log:
                 self.log.logOpen()
         finally:
-            self._lock.release()
+            self._releaseAll()
 
     def close(self):
-        self._lock.acquire()
+        self._acquireAll()
 
         try:
             if not self.is_open:
@@ -77,10 +93,10 @@ class Driver(object):
             if self.log:
                 self.log.logClose()
         finally:
-            self._lock.release()
+            self._releaseAll()
 
     def read(self, count):
-        self._lock.acquire()
+        self._read_lock.acquire()
 
         try:
             if not self.is_open:
@@ -90,17 +106,74 @@ class Driver(object):
 
             data = self._read(count)
             if self.log:
+                self._lock.acquire()
                 self.log.logRead(data)
+                self._lock.release()
 
             if self.debug:
                 self._dump(data, 'READ')
         finally:
-            self._lock.release()
+            self._read_lock.release()
 
         return data
 
-    def write(self, data):
-        self._lock.acquire()
+    def readinto(self, buffer_):
+        """Read up to len(buffer_) bytes into buffer_, a bytearray or a
+        writable memoryview, and return how many were read.
+
+        """
+        self._read_lock.acquire()
+
+        try:
+            if not self.is_open:
+                raise DriverError("Could not read from device (not open).")
+            if len(buffer_) <= 0:
+                raise DriverError("Could not read from device (zero request).")
+
+            count = self._readinto(buffer_)
+            if self.log or self.debug:
+                data = str(bytearray(buffer_[0:count]))
+            if self.log:
+                self._lock.acquire()
+                self.log.logRead(data)
+                self._lock.release()
+
+            if self.debug:
+                self._dump(data, 'READ')
+        finally:
+            self._read_lock.release()
+
+        return count
+
+    def wait(self, timeout):
+        """Block until there is data to read or timeout seconds pass.
+
+        Returns False on timeout. Drivers whose reads block on their own
+        return True straight away.
+
+        """
+        if not self.is_open:
+            time.sleep(timeout)
+            return False
+
+        return self._wait(timeout)
+
+    def fileno(self):
+        """File descriptor that becomes readable with data, if any."""
+        if not self.is_open:
+            return None
+
+        return self._fileno()
+
+    def available(self):
+        """Number of bytes that can be read without blocking, if known."""
+        if not self.is_open:
+            return 0
+
+        return self._available()
+
+    def write(self, data, offsets=None):
+        self._write_lock.acquire()
 
         try:
             if not self.is_open:
@@ -113,12 +186,35 @@ class Driver(object):
 
             ret = self._write(data)
             if self.log:
-                self.log.logWrite(data[0:ret])
+                self._lock.acquire()
+                if offsets:
+                    # One log entry per message in a batched write
+                    ends = list(offsets[1:]) + [len(data)]
+                    for start, end in zip(offsets, ends):
+                        if start < ret:
+                            self.log.logWrite(data[start:min(end, ret)])
+                else:
+                    self.log.logWrite(data[0:ret])
+                self._lock.release()
         finally:
-            self._lock.release()
+            self._write_lock.release()
 
         return ret
 
+    def writeMessages(self, messages):
+        data, offsets = Message.encodeBatch(messages)
+        return self.write(data, offsets)
+
+    def _acquireAll(self):
+        self._read_lock.acquire()
+        self._write_lock.acquire()
+        self._lock.acquire()
+
+    def _releaseAll(self):
+        self._lock.release()
+        self._write_lock.release()
+        self._read_lock.release()
+
     def _dump(self, data, title):
         if len(data) == 0:
             return
@@ -147,11 +243,29 @@ class Driver(object):
     def _write(self, data):
         raise DriverError("Not Implemented")
 
+    def _readinto(self, buffer_):
+        data = self._read(len(buffer_))
+        buffer_[0:len(data)] = data
+        return len(data)
+
+    def _wait(self, timeout):
+        # Without a way to block, throttle callers polling in a loop
+        time.sleep(0.002)
+        return True
+
+    def _fileno(self):
+        return None
+
+    def _available(self):
+        return 0
+
 
 class USB1Driver(Driver):
-    def __init__(self, device, baud_rate=115200, log=None, debug=False):
+    def __init__(self, device, baud_rate=115200, log=None, debug=False,
+                 max_chunk=USB1_MAX_CHUNK):
         Driver.__init__(self, device, log, debug)
         self.baud = baud_rate
+        self.max_chunk = max_chunk
 
     def _open(self):
         try:
@@ -171,6 +285,33 @@ class USB1Driver(Driver):
     def _read(self, count):
         return self._serial.read(count)
 
+    def _readinto(self, buffer_):
+        # pyserial's readinto() is read() plus a copy, so this still makes
+        # a string per read; only USB2Driver avoids that.
+        return self._serial.readinto(buffer_)
+
+    def _fileno(self):
+        try:
+            return self._serial.fileno()
+        except AttributeError:
+            return None  # Windows
+
+    def _wait(self, timeout):
+        fileno = self._fileno()
+        if fileno is None:
+            # Nothing to select on; read() blocks for the serial timeout
+            return True
+
+        return bool(select.select([fileno], [], [], timeout)[0])
+
+    def _available(self):
+        try:
+            waiting = self._serial.in_waiting
+        except AttributeError:
+            waiting = self._serial.inWaiting()  # pyserial < 3.0
+
+        return min(waiting, self.max_chunk)
+
     def _write(self, data):
         try:
             count = self._serial.write(data)
@@ -182,6 +323,12 @@ class USB1Driver(Driver):
 
 
 class USB2Driver(Driver):
+    def __init__(self, device, log=None, debug=False, packets=1):
+        Driver.__init__(self, device, log, debug)
+        self._packet = array('B')
+        self.packets = packets
+        self.read_size = packets * USB2_PACKET_SIZE
+
     def _open(self):
         # Most of this is straight from the PyUSB example documentation		
         dev = usb.core.find(idVendor=0x0fcf, idProduct=0x1008)
@@ -215,6 +362,9 @@ class USB2Driver(Driver):
         assert ep_in is not None
         self._ep_out = ep_out
         self._ep_in = ep_in
+        # Whole packets only: asking for less than a packet can overflow
+        # the transfer and lose the rest of it.
+        self.read_size = self.packets * ep_in.wMaxPacketSize
         self._dev = dev
         self._int = interface_number
 
@@ -231,7 +381,25 @@ class USB2Driver(Driver):
 
         return arr_inp.tostring()
 
+    def _readinto(self, buffer_):
+        # PyUSB only reads into an array.array, so read into one we keep
+        # around and copy out of it through a buffer() view.
+        if len(self._packet) != len(buffer_):
+            self._packet = array('B', '\x00' * len(buffer_))
+        try:
+            count = self._ep_in.read(self._packet)
+        except usb.core.USBError:
+            # Timeout errors seem to occasionally be expected
+            return 0
+
+        buffer_[0:count] = buffer(self._packet, 0, count)
+        return count
+
     def _write(self, data):
         count = self._ep_out.write(data)
 
         return count
+
+    def _wait(self, timeout):
+        # Endpoint reads block until a packet arrives or they time out
+        return True
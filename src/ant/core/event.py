@@ -31,22 +31,102 @@
 MAX_ACK_QUEUE = 25
 MAX_MSG_QUEUE = 25
 
+# What a full RingQueue does with one more message.
+OVERFLOW_DROP_OLDEST = 0
+OVERFLOW_DROP_NEWEST = 1
+OVERFLOW_BLOCK = 2
+OVERFLOW_SPILL = 3
+# Most bytes of messages an OVERFLOW_SPILL RingQueue keeps on disk; past
+# that the oldest spilled messages are dropped.
+SPILL_LIMIT = 1024 * 1024
+
+# How long the pump blocks waiting for data before checking whether it
+# should stop, and how much it reads when the driver can't say how much is
+# pending.
+PUMP_TIMEOUT = 0.1
+PUMP_READ_SIZE = 20
+
+# Default number of seconds waitForAck()/waitForMessage() block before
+# raising TimeoutError.
+WAIT_TIMEOUT = 10
+
+# How long reset() waits for the stick's startup message; firmware too old
+# to send one just takes this long to reset.
+RESET_TIMEOUT = 1
+
+import collections
+import Queue
+import select
+import tempfile
 import thread
+import threading
 import time
 
 from ant.core.constants import *
-from ant.core.message import Message, ChannelEventMessage
-from ant.core.exceptions import MessageError
+from ant.core.message import Message, ChannelMessage, ChannelEventMessage
+from ant.core.message import ChannelRequestMessage, SystemResetMessage
+from ant.core.exceptions import DriverError, MessageError, TimeoutError
+
+# Python 2.6 has no memoryview, so the pump can't read straight into the
+# Framer there; it reads a string and feeds it instead.
+try:
+    memoryview
+    HAS_MEMORYVIEW = True
+except NameError:
+    HAS_MEMORYVIEW = False
+
+
+class _Deadline(object):
+    # Condition.wait(timeout) polls with sleeps of up to 50 ms on Python 2,
+    # so timed waits block untimed and a single timer thread, started on
+    # the first wait, wakes them at the deadline instead.
+    def __init__(self, cond, timeout):
+        self.cond = cond
+        self.timer = None
+        self.expired = False
+        if timeout is None:
+            self.deadline = None
+        else:
+            self.deadline = time.time() + timeout
+
+    def wait(self, error):
+        """Wait on cond, which must be held; raise TimeoutError(error) once
+        the deadline has passed.
+
+        """
+        if self.deadline is not None and self.timer is None:
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                self.expired = True
+            else:
+                self.timer = threading.Timer(remaining, self._expire)
+                self.timer.start()
+        if self.expired:
+            raise TimeoutError(error)
+        self.cond.wait()
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def _expire(self):
+        self.cond.acquire()
+        try:
+            self.expired = True
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
 
 
 def ProcessBuffer(buffer_):
     messages = []
 
-    while True:
+    # Stop at the end of the buffer rather than decoding nothing
+    while buffer_:
         hf = Message()
         try:
             msg = hf.getHandler(buffer_)
-            buffer_ = buffer_[len(msg.getPayload()) + 4:]
+            buffer_ = buffer_[msg.getSize():]
             messages.append(msg)
         except MessageError, e:
             if e.internal == "CHECKSUM":
@@ -57,123 +137,872 @@ def ProcessBuffer(buffer_):
     return (buffer_, messages,)
 
 
+class Framer(object):
+    """Incremental frame decoder.
+
+    Chunks handed to feed() are copied into a preallocated bytearray and
+    consumed through read/write cursors, so every byte is copied a bounded
+    number of times no matter how much data is backlogged. The buffer is
+    compacted when the write cursor reaches the end, and only grows if a
+    single backlog does not fit in it.
+
+    With resync enabled (the default), garbage at the head of the buffer
+    and frames with a bad length or checksum are dropped by scanning
+    forward to the next TX sync byte, so line noise can never stall
+    decoding. Without it, decoding stops at the first bad frame header, as
+    ProcessBuffer() does. dropped_bytes, checksum_errors and resyncs count
+    what was discarded.
+
+    """
+    def __init__(self, capacity=4096, resync=True):
+        self.buffer = bytearray(capacity)
+        self.start = 0
+        self.end = 0
+        self.decoder = Message()
+        self.resync = resync
+        self.dropped_bytes = 0
+        self.checksum_errors = 0
+        self.resyncs = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def feed(self, data):
+        count = len(data)
+        if count:
+            if self.end + count > len(self.buffer):
+                self._compact(count)
+            self.buffer[self.end:self.end + count] = data
+            self.end += count
+
+        return self._frames()
+
+    def reserve(self, count):
+        """Return a writable view of count free bytes at the end of the
+        buffer, for the driver to read into. commit() what it wrote. Needs
+        memoryview (Python 2.7).
+
+        """
+        if self.end + count > len(self.buffer):
+            self._compact(count)
+        return memoryview(self.buffer)[self.end:self.end + count]
+
+    def commit(self, count):
+        self.end += count
+        return self._frames()
+
+    def _compact(self, count):
+        pending = self.end - self.start
+        if pending:
+            self.buffer[0:pending] = self.buffer[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+        if pending + count > len(self.buffer):
+            self.buffer.extend(bytearray(pending + count - len(self.buffer)))
+
+    def _frames(self):
+        messages = []
+        buffer_ = self.buffer
+
+        while self.end - self.start >= 5:
+            if buffer_[self.start] != MESSAGE_TX_SYNC or \
+            buffer_[self.start + 1] > 9:
+                if not self.resync:
+                    break
+                self._skip()
+                continue
+
+            size = buffer_[self.start + 1] + 4
+            if self.end - self.start < size:
+                break
+
+            try:
+                msg = self.decoder.getHandler(buffer_, self.start)
+            except MessageError, e:
+                if e.internal != 'CHECKSUM':
+                    break
+                self.checksum_errors += 1
+                if self.resync:
+                    self._skip()
+                else:
+                    self.start += size
+                continue
+
+            messages.append(msg)
+            self.start += size
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+        return messages
+
+    def _skip(self):
+        # Drop everything up to the next sync byte after the current one
+        sync = self.buffer.find(chr(MESSAGE_TX_SYNC), self.start + 1,
+                                self.end)
+        if sync == -1:
+            sync = self.end
+
+        self.dropped_bytes += sync - self.start
+        self.resyncs += 1
+        self.start = sync
+
+
 def EventPump(evm):
-    evm.pump_lock.acquire()
+    evm.pump_cond.acquire()
     evm.pump = True
-    evm.pump_lock.release()
+    evm.pump_cond.notifyAll()
+    evm.pump_cond.release()
 
     go = True
-    buffer_ = ''
-    while go:
-        evm.running_lock.acquire()
-        if not evm.running:
-            go = False
-        evm.running_lock.release()
-
-        buffer_ += evm.driver.read(20)
-        if len(buffer_) == 0:
-            continue
-        buffer_, messages = ProcessBuffer(buffer_)
-
-        evm.callbacks_lock.acquire()
-        for message in messages:
-            for callback in evm.callbacks:
-                try:
-                    callback.process(message)
-                except Exception, e:
-                    pass
+    try:
+        while go:
+            evm.running_lock.acquire()
+            if not evm.running:
+                go = False
+            evm.running_lock.release()
 
-        evm.callbacks_lock.release()
-
-        time.sleep(0.002)
-
-    evm.pump_lock.acquire()
-    evm.pump = False
-    evm.pump_lock.release()
+            evm.pumpOnce(PUMP_TIMEOUT)
+    except DriverError, e:
+        # The device is gone; keep the error, and let stop() return
+        evm.pump_error = e
+    finally:
+        evm.pump_cond.acquire()
+        evm.pump = False
+        evm.pump_cond.notifyAll()
+        evm.pump_cond.release()
 
 
 class EventCallback(object):
+    # Inline callbacks always run on the pump thread, even when the
+    # EventMachine hands everything else to a Dispatcher.
+    inline = False
+
     def process(self, msg):
         pass
 
 
+class Subscriber(object):
+    """A callback's bounded backlog inside a Dispatcher."""
+    def __init__(self, callback, maxsize):
+        self.callback = callback
+        self.maxsize = maxsize
+        self.queue = collections.deque()
+        self.lock = thread.allocate_lock()
+        self.scheduled = False
+        self.removed = False
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def depth(self):
+        return len(self.queue)
+
+    def push(self, msg):
+        # Returns True if the subscriber needs to be scheduled on a worker
+        self.lock.acquire()
+        if len(self.queue) >= self.maxsize:
+            self.queue.popleft()
+            self.dropped += 1
+        self.queue.append((msg, time.time()))
+        schedule = not self.scheduled
+        self.scheduled = True
+        self.lock.release()
+        return schedule
+
+    def run(self, batch):
+        # Returns True if messages are left over and it must be rescheduled
+        for i in xrange(batch):
+            self.lock.acquire()
+            if not self.queue or self.removed:
+                self.scheduled = False
+                self.lock.release()
+                return False
+            msg, queued = self.queue.popleft()
+            self.lock.release()
+
+            self.latency = time.time() - queued
+            self.max_latency = max(self.max_latency, self.latency)
+            try:
+                self.callback.process(msg)
+            except Exception, e:
+                self.errors += 1
+            self.processed += 1
+
+        return True
+
+
+class Dispatcher(object):
+    """Run EventMachine callbacks on a pool of worker threads.
+
+    Every callback gets its own bounded backlog; when it is full the
+    oldest message is dropped. A callback only ever runs on one worker at
+    a time, so it sees messages (and each channel's messages) in the order
+    they arrived, while different callbacks run in parallel and a slow one
+    can no longer hold up the pump.
+
+    """
+    def __init__(self, workers=4, maxsize=256, batch=16):
+        self.maxsize = maxsize
+        self.batch = batch
+        self.subscribers = {}
+        self.lock = thread.allocate_lock()
+        self.ready = Queue.Queue()
+        self.workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, callback, msg):
+        # Keyed by the callback itself: an id() could be reused once the
+        # callback is gone
+        subscriber = self.subscribers.get(callback)
+        if subscriber is None:
+            self.lock.acquire()
+            subscriber = self.subscribers.setdefault(
+                callback, Subscriber(callback, self.maxsize))
+            self.lock.release()
+
+        if subscriber.push(msg):
+            self.ready.put(subscriber)
+
+    def remove(self, callback):
+        self.lock.acquire()
+        subscriber = self.subscribers.pop(callback, None)
+        self.lock.release()
+
+        # A worker may be running it right now; stop it after this message
+        if subscriber is not None:
+            subscriber.lock.acquire()
+            subscriber.removed = True
+            subscriber.queue.clear()
+            subscriber.lock.release()
+
+    def depth(self):
+        return sum([s.depth() for s in self.subscribers.values()])
+
+    def stop(self):
+        for worker in self.workers:
+            self.ready.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def _work(self):
+        while True:
+            subscriber = self.ready.get()
+            if subscriber is None:
+                break
+            if subscriber.run(self.batch):
+                self.ready.put(subscriber)
+
+
+class Future(object):
+    """The eventual result of a command sent through an EventMachine.
+
+    Futures can be waited on from any thread other than the one pumping
+    the EventMachine, or chained with then()/addCallback() from any thread,
+    including the pump's own.
+
+    """
+    def __init__(self, key=None, discard=None):
+        self.key = key
+        self.discard = discard
+        self.result = None
+        self.error = None
+        self.done = False
+        self.callbacks = []
+        self.cond = threading.Condition()
+
+    def isDone(self):
+        return self.done
+
+    def resolve(self, result):
+        return self._settle(result, None)
+
+    def fail(self, error):
+        return self._settle(None, error)
+
+    def _settle(self, result, error):
+        self.cond.acquire()
+        if self.done:
+            self.cond.release()
+            return False
+        self.result = result
+        self.error = error
+        self.done = True
+        callbacks, self.callbacks = self.callbacks, []
+        self.cond.notifyAll()
+        self.cond.release()
+
+        for callback in callbacks:
+            callback(self)
+        return True
+
+    def addCallback(self, callback):
+        self.cond.acquire()
+        if not self.done:
+            self.callbacks.append(callback)
+            self.cond.release()
+            return
+        self.cond.release()
+        callback(self)
+
+    @staticmethod
+    def gather(futures):
+        """Return a Future resolving to futures once all of them are done,
+        whether they succeeded or not.
+
+        """
+        def cancel(gathered):
+            for future in futures:
+                future.cancel()
+
+        gathered = Future(discard=cancel)
+        remaining = [len(futures)]
+        lock = thread.allocate_lock()
+
+        def done(future):
+            lock.acquire()
+            remaining[0] -= 1
+            last = remaining[0] == 0
+            lock.release()
+            if last:
+                gathered.resolve(futures)
+
+        if not futures:
+            gathered.resolve(futures)
+        for future in futures:
+            future.addCallback(done)
+        return gathered
+
+    def then(self, func):
+        """Return a Future for func(result).
+
+        If func returns a Future, the returned one follows it; if func
+        raises, or this future fails, the returned one fails too.
+
+        """
+        future = Future(discard=lambda f: self.cancel())
+
+        def chain(done):
+            if done.error is not None:
+                future.fail(done.error)
+                return
+            try:
+                result = func(done.result)
+            except Exception, e:
+                future.fail(e)
+                return
+            if isinstance(result, Future):
+                future.discard = lambda f: result.cancel()
+                result.addCallback(
+                    lambda inner: future._settle(inner.result, inner.error))
+            else:
+                future.resolve(result)
+
+        self.addCallback(chain)
+        return future
+
+    def cancel(self, error=None):
+        """Stop waiting for a result; pending waiters get error."""
+        if self.discard is not None:
+            self.discard(self)
+        if error is None:
+            error = TimeoutError('Cancelled while waiting for response.')
+        return self.fail(error)
+
+    def wait(self, timeout=WAIT_TIMEOUT):
+        deadline = _Deadline(self.cond, timeout)
+        self.cond.acquire()
+        try:
+            try:
+                while not self.done:
+                    deadline.wait('Timed out waiting for response.')
+            finally:
+                self.cond.release()
+                deadline.cancel()
+        except TimeoutError, e:
+            if self.cancel(e):
+                raise
+
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class MessageStream(EventCallback):
+    """A bounded queue of messages, optionally limited to one channel.
+
+    When the queue is full new messages are dropped and counted, so a slow
+    reader never holds up the pump.
+
+    """
+    def __init__(self, maxsize=64, number=None):
+        self.queue = Queue.Queue(maxsize)
+        self.number = number
+        self.dropped = 0
+
+    def process(self, msg):
+        if self.number is not None and \
+        (not isinstance(msg, ChannelMessage) or \
+         msg.getChannelNumber() != self.number):
+            return
+        try:
+            self.queue.put_nowait(msg)
+        except Queue.Full:
+            self.dropped += 1
+
+    def get(self, timeout=None):
+        try:
+            return self.queue.get(True, timeout)
+        except Queue.Empty:
+            raise TimeoutError('Timed out waiting for message.')
+
+    def poll(self):
+        try:
+            return self.queue.get_nowait()
+        except Queue.Empty:
+            return None
+
+    def __iter__(self):
+        while True:
+            yield self.queue.get()
+
+
+class RingQueue(object):
+    """A bounded message queue with a configurable overflow policy.
+
+    OVERFLOW_DROP_OLDEST and OVERFLOW_DROP_NEWEST discard a message and
+    count it in dropped. OVERFLOW_BLOCK makes put() wait up to
+    block_timeout seconds (None: forever) for room before dropping the new
+    message. On the EventMachine's queues that holds up the pump, and so
+    every channel, until a reader catches up, and block_timeout must not
+    be None there. OVERFLOW_SPILL moves the oldest message to a temporary file,
+    where take() still finds it; at most spill_limit bytes are kept there,
+    and the oldest spilled messages are dropped to make room. peak is the
+    deepest the queue has been.
+
+    """
+    def __init__(self, capacity, policy=OVERFLOW_DROP_OLDEST,
+                 block_timeout=WAIT_TIMEOUT, spill_limit=SPILL_LIMIT):
+        self.capacity = capacity
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.spill_limit = spill_limit
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+        self.waiters = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.peak = 0
+        self.spill = None
+        # [sequence number, offset, size] for each spilled message, oldest
+        # first. Sequence numbers only grow, so take() can tell which ones
+        # it already looked at.
+        self.spill_index = collections.deque()
+        self.spill_bytes = 0  # Live bytes in the file
+        self.spill_end = 0
+        self.spill_seq = 0
+
+    def __len__(self):
+        return len(self.items) + len(self.spill_index)
+
+    def put(self, msg):
+        self.cond.acquire()
+        try:
+            if len(self.items) >= self.capacity and not self._makeRoom():
+                self.dropped += 1
+                return False
+            self.items.append(msg)
+            self.peak = max(self.peak, len(self))
+            if self.waiters:
+                self.cond.notifyAll()
+            return True
+        finally:
+            self.cond.release()
+
+    def take(self, match, timeout=WAIT_TIMEOUT,
+             error='Timed out waiting for message.'):
+        """Remove and return the oldest message for which match() is true,
+        waiting up to timeout seconds for one to arrive.
+
+        """
+        deadline = _Deadline(self.cond, timeout)
+        checked = -1  # Newest spilled message looked at so far
+        self.cond.acquire()
+        try:
+            while True:
+                msg, checked = self._find(match, checked)
+                if msg is not None:
+                    if self.waiters:
+                        self.cond.notifyAll()
+                    return msg
+                self._wait(deadline, error)
+        finally:
+            self.cond.release()
+            deadline.cancel()
+
+    def _wait(self, deadline, error):
+        self.waiters += 1
+        try:
+            deadline.wait(error)
+        finally:
+            self.waiters -= 1
+
+    def _makeRoom(self):
+        if self.policy == OVERFLOW_DROP_OLDEST:
+            self.items.popleft()
+            self.dropped += 1
+            return True
+        elif self.policy == OVERFLOW_SPILL:
+            self._spill(self.items.popleft())
+            return True
+        elif self.policy == OVERFLOW_BLOCK:
+            deadline = _Deadline(self.cond, self.block_timeout)
+            try:
+                while len(self.items) >= self.capacity:
+                    self._wait(deadline, 'Queue full.')
+            except TimeoutError:
+                return False
+            finally:
+                deadline.cancel()
+            return True
+        return False
+
+    def _spill(self, msg):
+        raw = msg.encode()
+        while self.spill_index and \
+        self.spill_bytes + len(raw) > self.spill_limit:
+            self._unspill(self.spill_index[0])
+            self.dropped += 1
+        if len(raw) > self.spill_limit:
+            self.dropped += 1
+            return
+
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile()
+        elif self.spill_end - self.spill_bytes > self.spill_limit:
+            self._compact()
+        self.spill.seek(self.spill_end)
+        self.spill.write(raw)
+        self.spill_index.append([self.spill_seq, self.spill_end, len(raw)])
+        self.spill_seq += 1
+        self.spill_end += len(raw)
+        self.spill_bytes += len(raw)
+        self.spilled += 1
+
+    def _unspill(self, entry):
+        self.spill_index.remove(entry)
+        self.spill_bytes -= entry[2]
+        if not self.spill_index:
+            self.spill.seek(0)
+            self.spill.truncate()
+            self.spill_end = 0
+
+    def _compact(self):
+        # Taken messages leave holes; copy the rest to a fresh file
+        spill = tempfile.TemporaryFile()
+        for entry in self.spill_index:
+            self.spill.seek(entry[1])
+            entry[1] = spill.tell()
+            spill.write(self.spill.read(entry[2]))
+        self.spill.close()
+        self.spill = spill
+        self.spill_end = spill.tell()
+
+    def _find(self, match, checked):
+        # Spilled messages are always older than the ones in memory. Each
+        # one is read back at most once per take().
+        for entry in self.spill_index:
+            if entry[0] <= checked:
+                continue
+            checked = entry[0]
+            self.spill.seek(entry[1])
+            msg = Message().getHandler(self.spill.read(entry[2]))
+            if match(msg):
+                self._unspill(entry)
+                return msg, checked
+
+        for msg in self.items:
+            if match(msg):
+                self.items.remove(msg)
+                return msg, checked
+        return None, checked
+
+
 class AckCallback(EventCallback):
+    inline = True
+
     def __init__(self, evm):
         self.evm = evm
 
     def process(self, msg):
         if isinstance(msg, ChannelEventMessage):
-            self.evm.ack_lock.acquire()
-            self.evm.ack.append(msg)
-            if len(self.evm.ack) > MAX_ACK_QUEUE:
-                self.evm.ack = self.evm.ack[-MAX_ACK_QUEUE:]
-            self.evm.ack_lock.release()
+            if self.evm._resolve(self.evm._eventKeys(msg), msg):
+                return
+
+            self.evm.ack.put(msg)
 
 
 class MsgCallback(EventCallback):
+    inline = True
+
     def __init__(self, evm):
         self.evm = evm
 
     def process(self, msg):
-        self.evm.msg_lock.acquire()
-        self.evm.msg.append(msg)
-        if len(self.evm.msg) > MAX_MSG_QUEUE:
-            self.evm.msg = self.evm.msg[-MAX_MSG_QUEUE:]
-        self.evm.msg_lock.release()
+        if self.evm._resolve(self.evm._messageKeys(msg), msg):
+            return
 
+        self.evm.msg.put(msg)
 
-class EventMachine(object):
-    callbacks_lock = thread.allocate_lock()
-    running_lock = thread.allocate_lock()
-    pump_lock = thread.allocate_lock()
-    ack_lock = thread.allocate_lock()
-    msg_lock = thread.allocate_lock()
 
-    def __init__(self, driver):
+class EventMachine(object):
+    def __init__(self, driver, ack_queue=None, msg_queue=None):
         self.driver = driver
-        self.callbacks = []
+        self.index = ((), {})
+        self.callbacks_lock = thread.allocate_lock()
         self.running = False
+        self.running_lock = thread.allocate_lock()
         self.pump = False
-        self.ack = []
-        self.msg = []
-        self.registerCallback(AckCallback(self))
-        self.registerCallback(MsgCallback(self))
+        self.pump_error = None
+        self.pump_lock = thread.allocate_lock()
+        self.pump_cond = threading.Condition(self.pump_lock)
+        if ack_queue is None:
+            ack_queue = RingQueue(MAX_ACK_QUEUE)
+        if msg_queue is None:
+            msg_queue = RingQueue(MAX_MSG_QUEUE)
+        for queue in (ack_queue, msg_queue):
+            if queue.policy == OVERFLOW_BLOCK and queue.block_timeout is None:
+                # The pump fills these; stop() could never get it back
+                raise ValueError('OVERFLOW_BLOCK needs a block_timeout.')
+        self.ack = ack_queue
+        self.msg = msg_queue
+        self.framer = Framer()
+        self.pending = {}
+        self.pending_lock = thread.allocate_lock()
+        self.dispatcher = None
+        self.subscribe(AckCallback(self), ChannelEventMessage)
+        self.subscribe(MsgCallback(self))
+
+    def pumpOnce(self, timeout=0):
+        """Read and dispatch whatever the driver has within timeout."""
+        if not self.driver.wait(timeout):
+            return []
+
+        count = self.driver.available() or self.driver.read_size or \
+                PUMP_READ_SIZE
+        if HAS_MEMORYVIEW:
+            count = self.driver.readinto(self.framer.reserve(count))
+            messages = self.framer.commit(count)
+        else:
+            messages = self.framer.feed(self.driver.read(count))
+        if messages:
+            self.dispatch(messages)
+        return messages
+
+    def dispatch(self, messages):
+        # Lock-free: subscribe() never mutates an index, it swaps in a new
+        # one, so a single read gives a consistent snapshot.
+        dispatcher = self.dispatcher
+        subscriptions, routes = self.index
+        for message in messages:
+            if isinstance(message, ChannelMessage):
+                key = (message.__class__, message.getChannelNumber())
+            else:
+                key = (message.__class__, None)
+            route = routes.get(key)
+            if route is None:
+                route = routes[key] = self._route(subscriptions, key)
+
+            for callback in route:
+                if dispatcher is not None and \
+                not getattr(callback, 'inline', False):
+                    dispatcher.submit(callback, message)
+                    continue
+                try:
+                    callback.process(message)
+                except Exception, e:
+                    pass
+
+    def setDispatcher(self, dispatcher):
+        """Run non-inline callbacks on dispatcher (None: on the pump)."""
+        self.dispatcher = dispatcher
+
+    def messages(self, maxsize=64):
+        """Return a MessageStream receiving every incoming message."""
+        stream = MessageStream(maxsize)
+        self.registerCallback(stream)
+        return stream
 
     def registerCallback(self, callback):
+        self.subscribe(callback)
+
+    def removeCallback(self, callback):
+        self.unsubscribe(callback)
+
+    def subscribe(self, callback, class_=None, number=None):
+        """Deliver messages of class_ (default: all) on channel number
+        (default: any channel) to callback.
+
+        """
+        entry = (callback, class_ or Message, number)
         self.callbacks_lock.acquire()
-        if callback not in self.callbacks:
-            self.callbacks.append(callback)
+        subscriptions, routes = self.index
+        if entry not in subscriptions:
+            self.index = (subscriptions + (entry,), {})
         self.callbacks_lock.release()
 
-    def removeCallback(self, callback):
+    def unsubscribe(self, callback):
         self.callbacks_lock.acquire()
-        if callback in self.callbacks:
-            self.callbacks.remove(callback)
+        subscriptions, routes = self.index
+        self.index = (tuple([entry for entry in subscriptions
+                             if entry[0] is not callback]), {})
         self.callbacks_lock.release()
+        if self.dispatcher is not None:
+            self.dispatcher.remove(callback)
 
-    def waitForAck(self, msg):
-        while True:
-            self.ack_lock.acquire()
-            for emsg in self.ack:
-                if msg.getType() != emsg.getMessageID():
-                    continue
-                self.ack.remove(emsg)
-                self.ack_lock.release()
-                return emsg.getMessageCode()
-            self.ack_lock.release()
-            time.sleep(0.002)
+    def _route(self, subscriptions, key):
+        class_, number = key
+        route = []
+        for callback, sub_class, sub_number in subscriptions:
+            if issubclass(class_, sub_class) and \
+            sub_number in (None, number) and callback not in route:
+                route.append(callback)
+        return tuple(route)
 
-    def waitForMessage(self, class_):
-        while True:
-            self.msg_lock.acquire()
-            for emsg in self.msg:
-                if not isinstance(emsg, class_):
-                    continue
-                self.msg.remove(emsg)
-                self.msg_lock.release()
-                return emsg
-            self.msg_lock.release()
-            time.sleep(0.002)
+    def sendCommand(self, msg):
+        """Write msg and return a Future for the response to it.
+
+        The future resolves to the ChannelEventMessage answering msg, matched
+        on channel number and message ID, so commands on different channels
+        can be in flight at the same time.
+
+        """
+        return self._send(self._ackKey(msg), msg)
+
+    def sendCommands(self, messages):
+        """Write messages back-to-back and return a list with a Future for
+        the response to each, as sendCommand() does for one.
+
+        """
+        futures = [self._expect(self._ackKey(msg)) for msg in messages]
+        try:
+            self.driver.writeMessages(messages)
+        except:
+            for future in futures:
+                future.cancel()
+            raise
+        return futures
+
+    def requestMessage(self, message_id, number=0x00):
+        """Send a ChannelRequestMessage and return a Future for the reply."""
+        return self._send(self._messageKey(message_id, number),
+                          ChannelRequestMessage(number, message_id))
+
+    def expectMessage(self, message_id, number=0x00):
+        """Return a Future for the next message of type message_id (on
+        channel number, for channel messages).
+
+        """
+        return self._expect(self._messageKey(message_id, number))
+
+    def expectEvent(self, number, code):
+        """Return a Future for the next channel event with the given code."""
+        return self._expect(('event', number, code))
+
+    def reset(self, timeout=RESET_TIMEOUT):
+        """Reset the stick and return its StartupMessage as soon as it
+        arrives, or None if none did within timeout seconds.
+
+        """
+        future = self._send(self._messageKey(MESSAGE_STARTUP, None),
+                            SystemResetMessage())
+        try:
+            return future.wait(timeout)
+        except TimeoutError:
+            return None
+
+    def _messageKey(self, message_id, number):
+        class_ = Message.handlers.get(message_id, Message)
+        if issubclass(class_, ChannelMessage):
+            return ('message', number, message_id)
+        return ('message', None, message_id)
+
+    def _ackKey(self, msg):
+        if isinstance(msg, ChannelMessage):
+            return ('ack', msg.getChannelNumber(), msg.getType())
+        return ('ack', None, msg.getType())
+
+    def _send(self, key, msg):
+        future = self._expect(key)
+        try:
+            self.driver.write(msg.encode())
+        except:
+            future.cancel()
+            raise
+        return future
+
+    def _expect(self, key):
+        future = Future(key, self._discard)
+        self.pending_lock.acquire()
+        self.pending.setdefault(key, []).append(future)
+        self.pending_lock.release()
+        return future
+
+    def _discard(self, future):
+        self.pending_lock.acquire()
+        futures = self.pending.get(future.key, [])
+        if future in futures:
+            futures.remove(future)
+            if not futures:
+                del self.pending[future.key]
+        self.pending_lock.release()
+
+    def _resolve(self, keys, msg):
+        future = None
+        self.pending_lock.acquire()
+        for key in keys:
+            futures = self.pending.get(key)
+            if futures:
+                future = futures.pop(0)
+                if not futures:
+                    del self.pending[key]
+                break
+        self.pending_lock.release()
+
+        if future is None:
+            return False
+        return future.resolve(msg)
+
+    def _eventKeys(self, msg):
+        number = msg.getChannelNumber()
+        message_id = msg.getMessageID()
+        if message_id == MESSAGE_RF_EVENT:
+            return (('event', number, msg.getMessageCode()),)
+        # Commands that aren't channel specific still get a channel byte
+        # echoed back, so fall back to matching on the message ID alone.
+        return (('ack', number, message_id), ('ack', None, message_id))
+
+    def _messageKeys(self, msg):
+        if isinstance(msg, ChannelMessage):
+            return (('message', msg.getChannelNumber(), msg.getType()),)
+        return (('message', None, msg.getType()),)
+
+    def waitForAck(self, msg, timeout=WAIT_TIMEOUT):
+        emsg = self.ack.take(
+            lambda emsg: emsg.getMessageID() == msg.getType(), timeout,
+            'Timed out waiting for acknowledgement.')
+        return emsg.getMessageCode()
+
+    def waitForMessage(self, class_, timeout=WAIT_TIMEOUT):
+        return self.msg.take(lambda emsg: isinstance(emsg, class_), timeout)
 
     def start(self, driver=None):
         self.running_lock.acquire()
@@ -184,15 +1013,13 @@ class EventMachine(object):
         self.running = True
         if driver is not None:
             self.driver = driver
+        self.pump_error = None
 
+        self.pump_cond.acquire()
         thread.start_new_thread(EventPump, (self,))
-        while True:
-            self.pump_lock.acquire()
-            if self.pump:
-                self.pump_lock.release()
-                break
-            self.pump_lock.release()
-            time.sleep(0.001)
+        while not self.pump:
+            self.pump_cond.wait()
+        self.pump_cond.release()
 
         self.running_lock.release()
 
@@ -205,10 +1032,70 @@ class EventMachine(object):
         self.running = False
         self.running_lock.release()
 
-        while True:
-            self.pump_lock.acquire()
-            if not self.pump:
-                self.pump_lock.release()
-                break
-            self.pump_lock.release()
-            time.sleep(0.001)
+        self.pump_cond.acquire()
+        while self.pump:
+            self.pump_cond.wait()
+        self.pump_cond.release()
+
+
+class EventLoop(object):
+    """Pump several EventMachines from a single thread.
+
+    Machines are handed over after their node has started; the loop stops
+    their pump threads and selects on all their drivers at once instead.
+    Only drivers with a file descriptor (see Driver.fileno()) can be
+    multiplexed this way. Callbacks and futures resolve on the loop's
+    thread, so code running there must chain futures rather than block
+    on them. A machine whose driver fails is removed from the loop, with
+    the error in its pump_error.
+
+    """
+    def __init__(self):
+        self.machines = {}
+        self.lock = thread.allocate_lock()
+        self.running = False
+
+    def add(self, evm):
+        fileno = evm.driver.fileno()
+        if fileno is None:
+            raise DriverError('Could not add event machine ' \
+                              '(driver has no file descriptor).')
+
+        evm.stop()
+        self.lock.acquire()
+        self.machines[fileno] = evm
+        self.lock.release()
+
+    def remove(self, evm):
+        self.lock.acquire()
+        for fileno, machine in self.machines.items():
+            if machine is evm:
+                del self.machines[fileno]
+        self.lock.release()
+
+    def runOnce(self, timeout=PUMP_TIMEOUT):
+        self.lock.acquire()
+        machines = dict(self.machines)
+        self.lock.release()
+
+        if not machines:
+            time.sleep(timeout)
+            return
+
+        ready = select.select(machines.keys(), [], [], timeout)[0]
+        for fileno in ready:
+            evm = machines[fileno]
+            try:
+                evm.pumpOnce(0)
+            except (DriverError, IOError, OSError), e:
+                # That device is gone; keep serving the others
+                evm.pump_error = e
+                self.remove(evm)
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.runOnce()
+
+    def stop(self):
+        self.running = False
@@ -44,3 +44,14 @@ class NodeError(ANTException):
 
 class ChannelError(ANTException):
     pass
+
+
+class ConfigurationError(ChannelError):
+    def __init__(self, msg, errors):
+        ChannelError.__init__(self, msg)
+        # (channel number, message type, error) for every failed step
+        self.errors = errors
+
+
+class TimeoutError(ANTException):
+    pass
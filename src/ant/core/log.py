@@ -23,18 +23,171 @@
 #
 ##############################################################################
 
+import os
 import time
 import datetime
 
 import msgpack
 
+from ant.core.constants import *
+from ant.core.message import Message, ChannelMessage
+
 EVENT_OPEN = 0x01
 EVENT_CLOSE = 0x02
 EVENT_READ = 0x03
 EVENT_WRITE = 0x04
 
+# How much of the log LogReader reads at a time
+READ_SIZE = 64 * 1024
+
+# The sidecar index is written next to the log, as <log>.idx
+INDEX_SUFFIX = '.idx'
+INDEX_BLOCK = 1024  # Events per index entry
+
+# Index entry fields
+INDEX_OFFSET = 0
+INDEX_END = 1
+INDEX_FIRST = 2
+INDEX_LAST = 3
+INDEX_CHANNELS = 4
+INDEX_TYPES = 5
+
+
+def _checkHeader(header, magic, error):
+    # [MAGIC, VERSION, ...]; returns whatever follows the version
+    if not isinstance(header, (list, tuple)) or \
+    list(header[:2]) != [magic, 0x01]:
+        raise IOError(error)
+    return list(header[2:])
+
+
+def _logStamp(filename):
+    # What ties an index to its log: the log's size and mtime once written.
+    # Both are packed as floats, which always take 9 bytes.
+    stat = os.stat(filename)
+    return [float(stat.st_size), stat.st_mtime]
+
+
+def _isSet(bitmap, numbers):
+    for number in numbers:
+        byte = number >> 3
+        if byte < len(bitmap) and ord(bitmap[byte]) & (1 << (number & 7)):
+            return True
+    return False
+
+
+class _Indexer(object):
+    # Sums blocks of a log up as [offset, end, first, last, channels, types]:
+    # where the block is, when it was logged and, as bitmaps, which channels
+    # and message types its frames carry. Blocks only end between frames,
+    # so a frame split across reads is never split across blocks.
+    def __init__(self, filename, block=INDEX_BLOCK):
+        self.filename = filename
+        self.fd = open(filename + INDEX_SUFFIX, 'wb')
+        self.packer = msgpack.Packer()
+        self.block = block
+        self.entry = None
+        self.count = 0
+        self.pending = {EVENT_READ: '', EVENT_WRITE: ''}
+        self.channel_types = set(type_ for type_, class_
+                                 in Message.handlers.items()
+                                 if issubclass(class_, ChannelMessage))
+
+        # Until close() stamps it, the index matches no log
+        self.fd.write(self._header([0.0, 0.0]))
+
+    def _header(self, stamp):
+        # [MAGIC, VERSION, LOG SIZE, LOG MTIME]
+        return self.packer.pack(['ANT-LOG-INDEX', 0x01] + stamp)
+
+    def add(self, offset, end, ev):
+        if self.count >= self.block and not any(self.pending.values()) or \
+        self.count >= 2 * self.block:
+            self.flush()
+        if self.entry is None:
+            self.entry = [offset, end, ev[1], ev[1],
+                          bytearray(32), bytearray(32)]
+        self.entry[INDEX_END] = end
+        self.entry[INDEX_LAST] = ev[1]
+        self.count += 1
+        if ev[0] in self.pending and len(ev) > 2:
+            self._walk(ev[0], ev[2])
+
+    def _walk(self, direction, data):
+        # Follow the frames closely enough to tell what they are; checksums
+        # are left to whoever decodes them.
+        buffer_ = self.pending[direction] + data
+        channels = self.entry[INDEX_CHANNELS]
+        types = self.entry[INDEX_TYPES]
+        sync = chr(MESSAGE_TX_SYNC)
+        i = 0
+        end = len(buffer_)
+        while end - i >= 4:
+            if buffer_[i] != sync or ord(buffer_[i + 1]) > 9:
+                i = buffer_.find(sync, i + 1)
+                if i == -1:
+                    i = end
+                continue
+
+            size = ord(buffer_[i + 1]) + 4
+            if end - i < size:
+                break
+            type_ = ord(buffer_[i + 2])
+            types[type_ >> 3] |= 1 << (type_ & 7)
+            if type_ in self.channel_types and size > 4:
+                number = ord(buffer_[i + 3])
+                channels[number >> 3] |= 1 << (number & 7)
+            i += size
+        self.pending[direction] = buffer_[i:]
+
+    def flush(self):
+        if self.entry is not None:
+            entry = self.entry[:INDEX_CHANNELS] + \
+                    [str(bitmap).rstrip('\x00')
+                     for bitmap in self.entry[INDEX_CHANNELS:]]
+            self.fd.write(self.packer.pack(entry))
+            self.entry = None
+            self.count = 0
+
+    def close(self):
+        """Finish the index; the log must be complete by now."""
+        self.flush()
+        self.fd.seek(0)
+        self.fd.write(self._header(_logStamp(self.filename)))
+        self.fd.close()
+
+
+def BuildIndex(filename, block=INDEX_BLOCK):
+    """Write the sidecar index of an existing log, as LogWriter would have
+    with index=True.
+
+    """
+    fd = open(filename, 'rb')
+    try:
+        unpacker = msgpack.Unpacker(fd, read_size=READ_SIZE)
+        _checkHeader(next(unpacker, None), 'ANT-LOG',
+                     'Could not open log file (unknown format).')
+
+        indexer = _Indexer(filename, block)
+        offset = unpacker.tell()
+        for ev in unpacker:
+            end = unpacker.tell()
+            indexer.add(offset, end, ev)
+            offset = end
+        indexer.close()
+    finally:
+        fd.close()
+
 
 class LogReader(object):
+    """Read a log, event by event or by iterating over it.
+
+    If the log has a sidecar index (see LogWriter and BuildIndex()), seek()
+    and query() use it to read only the blocks they need. An index that
+    doesn't match the log, as when the log was rewritten or appended to
+    since, is ignored.
+
+    """
     def __init__(self, filename):
         self.is_open = False
         self.open(filename)
@@ -47,17 +200,34 @@ class LogReader(object):
         if self.is_open == True:
             self.close()
 
-        self.fd = open(filename, 'r')
+        self.filename = filename
+        self.fd = open(filename, 'rb')
         self.is_open = True
-        self.unpacker = msgpack.Unpacker()
+        self.unpacker = msgpack.Unpacker(self.fd, read_size=READ_SIZE)
 
-        # Here be dragons
-        self.unpacker.feed(self.fd.read())
-        self.fd.close()
+        try:
+            _checkHeader(self.read(), 'ANT-LOG',
+                         'Could not open log file (unknown format).')
+        except:
+            self.close()
+            raise
+        self.start = self.unpacker.tell()
 
-        header = self.unpacker.unpack()
-        if len(header) != 2 or header[0] != 'ANT-LOG' or header[1] != 0x01:
-            raise IOError('Could not open log file (unknown format).')
+        self.index = None
+        if os.path.exists(filename + INDEX_SUFFIX):
+            self.index = self._readIndex(filename + INDEX_SUFFIX)
+
+    def _readIndex(self, filename):
+        fd = open(filename, 'rb')
+        try:
+            unpacker = msgpack.Unpacker(fd, read_size=READ_SIZE)
+            stamp = _checkHeader(next(unpacker, None), 'ANT-LOG-INDEX',
+                                 'Could not open log index (unknown format).')
+            if stamp != _logStamp(self.filename):
+                return None
+            return list(unpacker)
+        finally:
+            fd.close()
 
     def close(self):
         if self.is_open:
@@ -66,20 +236,101 @@ class LogReader(object):
 
     def read(self):
         try:
-            return self.unpacker.unpack()
+            return self.unpacker.next()
         except StopIteration:
             return None
 
+    def __iter__(self):
+        # Events are read from the file as they are iterated over. This
+        # holds on to the reader, which closes the file when collected.
+        for ev in self.unpacker:
+            yield ev
+
+    def seek(self, timestamp):
+        """Move on to the first event logged at or after timestamp."""
+        offset = self.start
+        for entry in self.index or ():
+            if entry[INDEX_LAST] >= timestamp:
+                offset = entry[INDEX_OFFSET]
+                break
+            offset = entry[INDEX_END]
+
+        self.fd.seek(offset)
+        unpacker = msgpack.Unpacker(self.fd, read_size=READ_SIZE)
+        position = 0
+        for ev in unpacker:
+            if ev[1] >= timestamp:
+                break
+            position = unpacker.tell()
+
+        self.fd.seek(offset + position)
+        self.unpacker = msgpack.Unpacker(self.fd, read_size=READ_SIZE)
+
+    def query(self, start=None, end=None, channels=None, types=None):
+        """Yield the events logged from start to end, inclusive, in blocks
+        carrying any of channels and any of types.
+
+        Events are raw reads and writes, so a block matching channels or
+        types is yielded whole. Without an index, only times are checked.
+        This doesn't move the reader.
+
+        """
+        fd = open(self.filename, 'rb')
+        try:
+            for offset, stop in self._regions(start, end, channels, types):
+                fd.seek(offset)
+                unpacker = msgpack.Unpacker(fd, read_size=READ_SIZE)
+                for ev in unpacker:
+                    if (start is None or ev[1] >= start) and \
+                    (end is None or ev[1] <= end):
+                        yield ev
+                    if stop is not None and offset + unpacker.tell() >= stop:
+                        break
+        finally:
+            fd.close()
+
+    def _regions(self, start, end, channels, types):
+        # The stretches of the log to read, merging adjacent blocks; what
+        # the index doesn't cover yet is always read
+        regions = []
+        tail = self.start
+        for entry in self.index or ():
+            tail = entry[INDEX_END]
+            if start is not None and entry[INDEX_LAST] < start or \
+            end is not None and entry[INDEX_FIRST] > end or \
+            channels is not None and \
+            not _isSet(entry[INDEX_CHANNELS], channels) or \
+            types is not None and not _isSet(entry[INDEX_TYPES], types):
+                continue
+
+            if regions and regions[-1][1] == entry[INDEX_OFFSET]:
+                regions[-1][1] = entry[INDEX_END]
+            else:
+                regions.append([entry[INDEX_OFFSET], entry[INDEX_END]])
+
+        if regions and regions[-1][1] == tail:
+            regions[-1][1] = None
+        else:
+            regions.append([tail, None])
+        return regions
+
 
 class LogWriter(object):
-    def __init__(self, filename=''):
+    """Log what a driver opens, reads and writes.
+
+    With index=True, a sidecar index for LogReader.seek() and query() is
+    written along with the log.
+
+    """
+    def __init__(self, filename='', index=False):
         self.packer = msgpack.Packer()
         self.is_open = False
+        self.index = index
         self.open(filename)
 
     def __del__(self):
         if self.is_open:
-            self.fd.close()
+            self.close()
 
     def open(self, filename=''):
         if filename == '':
@@ -89,16 +340,25 @@ class LogWriter(object):
         if self.is_open == True:
             self.close()
 
-        self.fd = open(filename, 'w')
+        self.fd = open(filename, 'wb')
         self.is_open = True
         self.packer = msgpack.Packer()
 
         header = ['ANT-LOG', 0x01]  # [MAGIC, VERSION]
         self.fd.write(self.packer.pack(header))
+        self.offset = self.fd.tell()
+
+        self.indexer = None
+        if self.index:
+            self.indexer = _Indexer(filename)
+        elif os.path.exists(filename + INDEX_SUFFIX):
+            os.remove(filename + INDEX_SUFFIX)
 
     def close(self):
         if self.is_open:
             self.fd.close()
+            if self.indexer is not None:
+                self.indexer.close()
             self.is_open = False
 
     def _logEvent(self, event, data=None):
@@ -109,7 +369,11 @@ class LogWriter(object):
         elif len(data) == 0:
             return
 
-        self.fd.write(self.packer.pack(ev))
+        packed = self.packer.pack(ev)
+        self.fd.write(packed)
+        if self.indexer is not None:
+            self.indexer.add(self.offset, self.offset + len(packed), ev)
+        self.offset += len(packed)
 
     def logOpen(self):
         self._logEvent(EVENT_OPEN)
@@ -23,28 +23,134 @@
 #
 ##############################################################################
 
+import re
 import struct
 
 from ant.core.exceptions import MessageError
 from ant.core.constants import *
 
 
+class Field(object):
+    """A fixed-offset, little-endian payload field.
+
+    The struct.Struct is compiled once per field, so every read is a single
+    unpack_from() on the payload bytearray and every write a single
+    pack_into().
+
+    """
+    def __init__(self, name, offset, format_):
+        self.name = name
+        self.offset = offset
+        self.struct = struct.Struct('<' + format_.lstrip('<'))
+        self.label = re.sub(r'(?<=[a-z0-9])([A-Z])', r' \1', name).lower()
+        self.is_string = format_.endswith('s')
+
+    def get(self, msg):
+        return self.struct.unpack_from(msg._payload, self.offset)[0]
+
+    def set(self, msg, value):
+        if self.is_string and len(value) != self.struct.size:
+            raise MessageError('Could not set %s (expected %d bytes).' %
+                               (self.label, self.struct.size))
+
+        try:
+            self.struct.pack_into(msg._payload, self.offset, value)
+        except struct.error:
+            raise MessageError('Could not set %s (out of range).' %
+                               self.label)
+
+        if msg._frame is not None:
+            msg._patchFrame(self.offset, self.offset + self.struct.size)
+
+
+class MessageMeta(type):
+    """Turn a class' (name, offset, format) `fields` into get/set methods.
+
+    Hand-written getters or setters in the class body take precedence over
+    the generated ones.
+
+    """
+    def __init__(cls, name, bases, dict_):
+        super(MessageMeta, cls).__init__(name, bases, dict_)
+
+        for spec in dict_.get('fields', ()):
+            field = Field(*spec)
+            if 'get' + field.name not in dict_:
+                setattr(cls, 'get' + field.name, cls._getter(field))
+            if 'set' + field.name not in dict_:
+                setattr(cls, 'set' + field.name, cls._setter(field))
+
+    @staticmethod
+    def _getter(field):
+        def getter(self):
+            return field.get(self)
+        getter.__name__ = 'get' + field.name
+        return getter
+
+    @staticmethod
+    def _setter(field):
+        def setter(self, value):
+            field.set(self, value)
+        setter.__name__ = 'set' + field.name
+        return setter
+
+
 class Message(object):
+    __metaclass__ = MessageMeta
+
+    # Message type -> class used by getHandler(). Populated at the bottom of
+    # this module; see registerHandler() for adding new types.
+    handlers = {}
+
+    # (name, offset, struct format) for each payload field; MessageMeta
+    # generates get<name>()/set<name>() from these.
+    fields = ()
+
+    # Encoded frame cache. _frame is patched in place by field setters;
+    # anything that changes the payload length or type drops both, and so
+    # does handing out the payload, which may then be changed in place.
+    _frame = None
+    _raw = None
+    _payload = None
+
     def __init__(self, type_=0x00, payload=''):
         self.setType(type_)
         self.setPayload(payload)
 
+    @classmethod
+    def fromPayload(cls, type_, payload):
+        """Build a message without running __init__ or validating anything.
+
+        Meant for frames that already went through decode(); user-built
+        messages should go through the regular constructor and setters.
+
+        """
+        msg = cls.__new__(cls)
+        msg.type_ = type_
+        msg._payload = bytearray(payload)
+        return msg
+
+    def _getPayloadBuffer(self):
+        if self._frame is not None:
+            self._invalidate()
+        return self._payload
+
+    def _setPayloadBuffer(self, payload):
+        self._payload = payload
+        self._invalidate()
+
+    payload = property(_getPayloadBuffer, _setPayloadBuffer)
+
     def getPayload(self):
-        return ''.join(self.payload)
+        return str(self._payload)
 
     def setPayload(self, payload):
         if len(payload) > 9:
             raise MessageError(
                   'Could not set payload (payload too long).')
 
-        self.payload = []
-        for byte in payload:
-            self.payload += byte
+        self._payload = bytearray(payload)
+        self._invalidate()
 
     def getType(self):
         return self.type_
@@ -54,123 +160,127 @@ class Message(object):
             raise MessageError('Could not set type (type out of range).')
 
         self.type_ = type_
+        self._invalidate()
 
     def getChecksum(self):
-        data = chr(len(self.getPayload()))
-        data += chr(self.getType())
-        data += self.getPayload()
+        if self._frame is not None:
+            return self._frame[-1]
 
-        checksum = MESSAGE_TX_SYNC
-        for byte in data:
-            checksum = (checksum ^ ord(byte)) % 0xFF
+        checksum = MESSAGE_TX_SYNC ^ len(self._payload) ^ self.type_
+        for byte in self._payload:
+            checksum ^= byte
 
         return checksum
 
     def getSize(self):
-        return len(self.getPayload()) + 4
+        return len(self._payload) + 4
 
     def encode(self):
-        raw = struct.pack('BBB',
-                          MESSAGE_TX_SYNC,
-                          len(self.getPayload()),
-                          self.getType())
-        raw += self.getPayload()
-        raw += chr(self.getChecksum())
-
-        return raw
-
-    def decode(self, raw):
-        if len(raw) < 5:
+        if self._raw is None:
+            if self._frame is None:
+                frame = bytearray(struct.pack('BBB',
+                                              MESSAGE_TX_SYNC,
+                                              len(self._payload),
+                                              self.type_))
+                frame += self._payload
+                frame.append(self.getChecksum())
+                self._frame = frame
+            self._raw = str(self._frame)
+
+        return self._raw
+
+    def _invalidate(self):
+        self._frame = None
+        self._raw = None
+
+    def _patchFrame(self, start, end):
+        # Copy payload[start:end] into the cached frame, folding each
+        # changed byte into the checksum instead of recomputing it.
+        frame = self._frame
+        checksum = frame[-1]
+        for i in xrange(start, end):
+            byte = self._payload[i]
+            checksum ^= frame[i + 3] ^ byte
+            frame[i + 3] = byte
+        frame[-1] = checksum
+        self._raw = None
+
+    def decode(self, raw, offset=0):
+        """Decode the frame starting at raw[offset].
+
+        raw may be a str, bytearray or memoryview; the payload is copied
+        straight out of it without slicing the buffer first.
+
+        """
+        if len(raw) - offset < 5:
             raise MessageError('Could not decode (message is incomplete).')
 
-        sync, length, type_ = struct.unpack('BBB', raw[:3])
+        sync, length, type_ = struct.unpack_from('BBB', raw, offset)
 
         if sync != MESSAGE_TX_SYNC:
             raise MessageError('Could not decode (expected TX sync).')
         if length > 9:
             raise MessageError('Could not decode (payload too long).')
-        if len(raw) < (length + 4):
+        if len(raw) - offset < (length + 4):
             raise MessageError('Could not decode (message is incomplete).')
 
         self.setType(type_)
-        self.setPayload(raw[3:length + 3])
+        self._payload[:] = raw[offset + 3:offset + length + 3]
+        self._invalidate()
 
-        if self.getChecksum() != ord(raw[length + 3]):
+        checksum = struct.unpack_from('B', raw, offset + length + 3)[0]
+        if self.getChecksum() != checksum:
             raise MessageError('Could not decode (bad checksum).',
                                internal='CHECKSUM')
 
         return self.getSize()
 
-    def getHandler(self, raw=None):
-        if raw:
-            self.decode(raw)
-
-        msg = None
-        if self.type_ == MESSAGE_CHANNEL_UNASSIGN:
-            msg = ChannelUnassignMessage()
-        elif self.type_ == MESSAGE_CHANNEL_ASSIGN:
-            msg = ChannelAssignMessage()
-        elif self.type_ == MESSAGE_CHANNEL_ID:
-            msg = ChannelIDMessage()
-        elif self.type_ == MESSAGE_CHANNEL_PERIOD:
-            msg = ChannelPeriodMessage()
-        elif self.type_ == MESSAGE_CHANNEL_SEARCH_TIMEOUT:
-            msg = ChannelSearchTimeoutMessage()
-        elif self.type_ == MESSAGE_CHANNEL_FREQUENCY:
-            msg = ChannelFrequencyMessage()
-        elif self.type_ == MESSAGE_CHANNEL_TX_POWER:
-            msg = ChannelTXPowerMessage()
-        elif self.type_ == MESSAGE_NETWORK_KEY:
-            msg = NetworkKeyMessage()
-        elif self.type_ == MESSAGE_TX_POWER:
-            msg = TXPowerMessage()
-        elif self.type_ == MESSAGE_SYSTEM_RESET:
-            msg = SystemResetMessage()
-        elif self.type_ == MESSAGE_CHANNEL_OPEN:
-            msg = ChannelOpenMessage()
-        elif self.type_ == MESSAGE_CHANNEL_CLOSE:
-            msg = ChannelCloseMessage()
-        elif self.type_ == MESSAGE_CHANNEL_REQUEST:
-            msg = ChannelRequestMessage()
-        elif self.type_ == MESSAGE_CHANNEL_BROADCAST_DATA:
-            msg = ChannelBroadcastDataMessage()
-        elif self.type_ == MESSAGE_CHANNEL_ACKNOWLEDGED_DATA:
-            msg = ChannelAcknowledgedDataMessage()
-        elif self.type_ == MESSAGE_CHANNEL_BURST_DATA:
-            msg = ChannelBurstDataMessage()
-        elif self.type_ == MESSAGE_CHANNEL_EVENT:
-            msg = ChannelEventMessage()
-        elif self.type_ == MESSAGE_CHANNEL_STATUS:
-            msg = ChannelStatusMessage()
-        elif self.type_ == MESSAGE_VERSION:
-            msg = VersionMessage()
-        elif self.type_ == MESSAGE_CAPABILITIES:
-            msg = CapabilitiesMessage()
-        elif self.type_ == MESSAGE_SERIAL_NUMBER:
-            msg = SerialNumberMessage()
-        else:
-            raise MessageError('Could not find message handler ' \
-                               '(unknown message type).')
-
-        msg.setPayload(self.getPayload())
-        return msg
+    def getHandler(self, raw=None, offset=0):
+        if raw is not None:
+            self.decode(raw, offset)
+
+        class_ = self.handlers.get(self.type_, Message)
+        return class_.fromPayload(self.type_, self._payload)
+
+    @staticmethod
+    def encodeBatch(messages):
+        """Encode messages back to back into a single buffer.
+
+        Returns (data, offsets), where offsets[i] is the position of
+        messages[i] within data.
+
+        """
+        frames = []
+        offsets = []
+        offset = 0
+        for msg in messages:
+            raw = msg.encode()
+            frames.append(raw)
+            offsets.append(offset)
+            offset += len(raw)
+
+        return ''.join(frames), offsets
+
+    @staticmethod
+    def registerHandler(type_, class_):
+        if (type_ > 0xFF) or (type_ < 0x00):
+            raise MessageError('Could not register handler ' \
+                               '(type out of range).')
+
+        Message.handlers[type_] = class_
+
+    @staticmethod
+    def removeHandler(type_):
+        Message.handlers.pop(type_, None)
 
 
 class ChannelMessage(Message):
+    fields = (('ChannelNumber', 0, 'B'),)
+
     def __init__(self, type_, payload='', number=0x00):
         Message.__init__(self, type_, '\x00' + payload)
         self.setChannelNumber(number)
 
-    def getChannelNumber(self):
-        return ord(self.payload[0])
-
-    def setChannelNumber(self, number):
-        if (number > 0xFF) or (number < 0x00):
-            raise MessageError('Could not set channel number ' \
-                                   '(out of range).')
-
-        self.payload[0] = chr(number)
-
 
 # Config messages
 class ChannelUnassignMessage(ChannelMessage):
@@ -180,25 +290,21 @@ class ChannelUnassignMessage(ChannelMessage):
 
 
 class ChannelAssignMessage(ChannelMessage):
+    fields = (('ChannelType', 1, 'B'),
+              ('NetworkNumber', 2, 'B'),)
+
     def __init__(self, number=0x00, type_=0x00, network=0x00):
-        payload = struct.pack('BB', type_, network)
         ChannelMessage.__init__(self, type_=MESSAGE_CHANNEL_ASSIGN,
-                                payload=payload, number=number)
-
-    def getChannelType(self):
-        return ord(self.payload[1])
-
-    def setChannelType(self, type_):
-        self.payload[1] = chr(type_)
-
-    def getNetworkNumber(self):
-        return ord(self.payload[2])
-
-    def setNetworkNumber(self, number):
-        self.payload[2] = chr(number)
+                                payload='\x00' * 2, number=number)
+        self.setChannelType(type_)
+        self.setNetworkNumber(network)
 
 
 class ChannelIDMessage(ChannelMessage):
+    fields = (('DeviceNumber', 1, 'H'),
+              ('DeviceType', 3, 'B'),
+              ('TransmissionType', 4, 'B'),)
+
     def __init__(self, number=0x00, device_number=0x0000, device_type=0x00,
                  trans_type=0x00):
         ChannelMessage.__init__(self, type_=MESSAGE_CHANNEL_ID,
@@ -207,105 +313,68 @@ class ChannelIDMessage(ChannelMessage):
         self.setDeviceType(device_type)
         self.setTransmissionType(trans_type)
 
-    def getDeviceNumber(self):
-        return struct.unpack('<H', self.getPayload()[1:3])[0]
-
-    def setDeviceNumber(self, device_number):
-        self.payload[1:3] = struct.pack('<H', device_number)
-
-    def getDeviceType(self):
-        return ord(self.payload[3])
-
-    def setDeviceType(self, device_type):
-        self.payload[3] = chr(device_type)
-
-    def getTransmissionType(self):
-        return ord(self.payload[4])
-
-    def setTransmissionType(self, trans_type):
-        self.payload[4] = chr(trans_type)
-
 
 class ChannelPeriodMessage(ChannelMessage):
+    fields = (('ChannelPeriod', 1, 'H'),)
+
     def __init__(self, number=0x00, period=8192):
         ChannelMessage.__init__(self, type_=MESSAGE_CHANNEL_PERIOD,
                                 payload='\x00' * 2, number=number)
         self.setChannelPeriod(period)
 
-    def getChannelPeriod(self):
-        return struct.unpack('<H', self.getPayload()[1:3])[0]
-
-    def setChannelPeriod(self, period):
-        self.payload[1:3] = struct.pack('<H', period)
-
 
 class ChannelSearchTimeoutMessage(ChannelMessage):
+    fields = (('Timeout', 1, 'B'),)
+
     def __init__(self, number=0x00, timeout=0xFF):
         ChannelMessage.__init__(self, type_=MESSAGE_CHANNEL_SEARCH_TIMEOUT,
                                 payload='\x00', number=number)
         self.setTimeout(timeout)
 
-    def getTimeout(self):
-        return ord(self.payload[1])
-
-    def setTimeout(self, timeout):
-        self.payload[1] = chr(timeout)
-
 
 class ChannelFrequencyMessage(ChannelMessage):
+    fields = (('Frequency', 1, 'B'),)
+
     def __init__(self, number=0x00, frequency=66):
         ChannelMessage.__init__(self, type_=MESSAGE_CHANNEL_FREQUENCY,
                                 payload='\x00', number=number)
         self.setFrequency(frequency)
 
-    def getFrequency(self):
-        return ord(self.payload[1])
-
-    def setFrequency(self, frequency):
-        self.payload[1] = chr(frequency)
-
 
 class ChannelTXPowerMessage(ChannelMessage):
+    fields = (('Power', 1, 'B'),)
+
     def __init__(self, number=0x00, power=0x00):
         ChannelMessage.__init__(self, type_=MESSAGE_CHANNEL_TX_POWER,
                                 payload='\x00', number=number)
-
-    def getPower(self):
-        return ord(self.payload[1])
-
-    def setPower(self, power):
-        self.payload[1] = chr(power)
+        self.setPower(power)
 
 
 class NetworkKeyMessage(Message):
+    fields = (('Number', 0, 'B'),
+              ('Key', 1, '8s'),)
+
     def __init__(self, number=0x00, key='\x00' * 8):
         Message.__init__(self, type_=MESSAGE_NETWORK_KEY, payload='\x00' * 9)
         self.setNumber(number)
         self.setKey(key)
 
-    def getNumber(self):
-        return ord(self.payload[0])
-
-    def setNumber(self, number):
-        self.payload[0] = chr(number)
-
-    def getKey(self):
-        return self.getPayload()[1:]
-
-    def setKey(self, key):
-        self.payload[1:] = key
-
 
 class TXPowerMessage(Message):
+    fields = (('Power', 1, 'B'),)
+
     def __init__(self, power=0x00):
         Message.__init__(self, type_=MESSAGE_TX_POWER, payload='\x00\x00')
         self.setPower(power)
 
-    def getPower(self):
-        return ord(self.payload[1])
 
-    def setPower(self, power):
-        self.payload[1] = chr(power)
+# Notification messages
+class StartupMessage(Message):
+    fields = (('Reason', 0, 'B'),)
+
+    def __init__(self, reason=STARTUP_POWER_ON_RESET):
+        Message.__init__(self, type_=MESSAGE_STARTUP, payload='\x00')
+        self.setReason(reason)
 
 
 # Control messages
@@ -327,40 +396,47 @@ class ChannelCloseMessage(ChannelMessage):
 
 
 class ChannelRequestMessage(ChannelMessage):
+    fields = (('MessageID', 1, 'B'),)
+
     def __init__(self, number=0x00, message_id=MESSAGE_CHANNEL_STATUS):
         ChannelMessage.__init__(self, type_=MESSAGE_CHANNEL_REQUEST,
                                 number=number, payload='\x00')
         self.setMessageID(message_id)
 
-    def getMessageID(self):
-        return ord(self.payload[1])
-
-    def setMessageID(self, message_id):
-        if (message_id > 0xFF) or (message_id < 0x00):
-            raise MessageError('Could not set message ID ' \
-                                   '(out of range).')
-
-        self.payload[1] = chr(message_id)
-
 
 class RequestMessage(ChannelRequestMessage):
     pass
 
 
 # Data messages
-class ChannelBroadcastDataMessage(ChannelMessage):
+class ChannelDataMessage(ChannelMessage):
+    def getData(self):
+        return str(self._payload[1:])
+
+    def setData(self, data):
+        # Same-sized data is patched into the cached frame, so a master
+        # channel can keep reusing one message
+        if len(data) + 1 != len(self._payload):
+            self.setPayload(chr(self.getChannelNumber()) + data)
+            return
+        self._payload[1:] = data
+        if self._frame is not None:
+            self._patchFrame(1, len(self._payload))
+
+
+class ChannelBroadcastDataMessage(ChannelDataMessage):
     def __init__(self, number=0x00, data='\x00' * 7):
         ChannelMessage.__init__(self, type_=MESSAGE_CHANNEL_BROADCAST_DATA,
                                 payload=data, number=number)
 
 
-class ChannelAcknowledgedDataMessage(ChannelMessage):
+class ChannelAcknowledgedDataMessage(ChannelDataMessage):
     def __init__(self, number=0x00, data='\x00' * 7):
         ChannelMessage.__init__(self, type_=MESSAGE_CHANNEL_ACKNOWLEDGED_DATA,
                                 payload=data, number=number)
 
 
-class ChannelBurstDataMessage(ChannelMessage):
+class ChannelBurstDataMessage(ChannelDataMessage):
     def __init__(self, number=0x00, data='\x00' * 7):
         ChannelMessage.__init__(self, type_=MESSAGE_CHANNEL_BURST_DATA,
                                 payload=data, number=number)
@@ -368,70 +444,53 @@ class ChannelBurstDataMessage(ChannelMessage):
 
 # Channel event messages
 class ChannelEventMessage(ChannelMessage):
+    fields = (('MessageID', 1, 'B'),
+              ('MessageCode', 2, 'B'),)
+
     def __init__(self, number=0x00, message_id=0x00, message_code=0x00):
         ChannelMessage.__init__(self, type_=MESSAGE_CHANNEL_EVENT,
                                 number=number, payload='\x00\x00')
         self.setMessageID(message_id)
         self.setMessageCode(message_code)
 
-    def getMessageID(self):
-        return ord(self.payload[1])
-
-    def setMessageID(self, message_id):
-        if (message_id > 0xFF) or (message_id < 0x00):
-            raise MessageError('Could not set message ID ' \
-                                   '(out of range).')
-
-        self.payload[1] = chr(message_id)
-
-    def getMessageCode(self):
-        return ord(self.payload[2])
-
-    def setMessageCode(self, message_code):
-        if (message_code > 0xFF) or (message_code < 0x00):
-            raise MessageError('Could not set message code ' \
-                                   '(out of range).')
-
-        self.payload[2] = chr(message_code)
-
 
 # Requested response messages
 class ChannelStatusMessage(ChannelMessage):
+    fields = (('Status', 1, 'B'),)
+
     def __init__(self, number=0x00, status=0x00):
         ChannelMessage.__init__(self, type_=MESSAGE_CHANNEL_STATUS,
                                 payload='\x00', number=number)
         self.setStatus(status)
 
-    def getStatus(self):
-        return ord(self.payload[1])
+    # The status byte packs the channel's state, network and type
+    def getChannelState(self):
+        return self.getStatus() & 0x03
 
-    def setStatus(self, status):
-        if (status > 0xFF) or (status < 0x00):
-            raise MessageError('Could not set channel status ' \
-                                   '(out of range).')
+    def getNetworkNumber(self):
+        return (self.getStatus() >> 2) & 0x03
 
-        self.payload[1] = chr(status)
+    def getChannelType(self):
+        return self.getStatus() & 0xF0
 
 #class ChannelIDMessage(ChannelMessage):
 
 
 class VersionMessage(Message):
+    fields = (('Version', 0, '9s'),)
+
     def __init__(self, version='\x00' * 9):
         Message.__init__(self, type_=MESSAGE_VERSION, payload='\x00' * 9)
         self.setVersion(version)
 
-    def getVersion(self):
-        return self.getPayload()
-
-    def setVersion(self, version):
-        if (len(version) != 9):
-            raise MessageError('Could not set ANT version ' \
-                               '(expected 9 bytes).')
-
-        self.setPayload(version)
-
 
 class CapabilitiesMessage(Message):
+    fields = (('MaxChannels', 0, 'B'),
+              ('MaxNetworks', 1, 'B'),
+              ('StdOptions', 2, 'B'),
+              ('AdvOptions', 3, 'B'),
+              ('AdvOptions2', 4, 'B'),)
+
     def __init__(self, max_channels=0x00, max_nets=0x00, std_opts=0x00,
                  adv_opts=0x00, adv_opts2=0x00):
         Message.__init__(self, type_=MESSAGE_CAPABILITIES, payload='\x00' * 4)
@@ -442,70 +501,52 @@ class CapabilitiesMessage(Message):
         if adv_opts2 is not None:
             self.setAdvOptions2(adv_opts2)
 
-    def getMaxChannels(self):
-        return ord(self.payload[0])
-
-    def getMaxNetworks(self):
-        return ord(self.payload[1])
-
-    def getStdOptions(self):
-        return ord(self.payload[2])
-
-    def getAdvOptions(self):
-        return ord(self.payload[3])
-
+    # Older sticks omit the second advanced options byte
     def getAdvOptions2(self):
-        return ord(self.payload[4]) if len(self.payload) == 5 else 0x00
-
-    def setMaxChannels(self, num):
-        if (num > 0xFF) or (num < 0x00):
-            raise MessageError('Could not set max channels ' \
-                                   '(out of range).')
-
-        self.payload[0] = chr(num)
-
-    def setMaxNetworks(self, num):
-        if (num > 0xFF) or (num < 0x00):
-            raise MessageError('Could not set max networks ' \
-                                   '(out of range).')
-
-        self.payload[1] = chr(num)
-
-    def setStdOptions(self, num):
-        if (num > 0xFF) or (num < 0x00):
-            raise MessageError('Could not set std options ' \
-                                   '(out of range).')
-
-        self.payload[2] = chr(num)
-
-    def setAdvOptions(self, num):
-        if (num > 0xFF) or (num < 0x00):
-            raise MessageError('Could not set adv options ' \
-                                   '(out of range).')
-
-        self.payload[3] = chr(num)
+        return self._payload[4] if len(self._payload) == 5 else 0x00
 
     def setAdvOptions2(self, num):
         if (num > 0xFF) or (num < 0x00):
             raise MessageError('Could not set adv options 2 ' \
                                    '(out of range).')
 
-        if len(self.payload) == 4:
-            self.payload.append('\x00')
-        self.payload[4] = chr(num)
+        if len(self._payload) == 4:
+            self._payload.append(0x00)
+            self._invalidate()
+        self._payload[4] = num
+        if self._frame is not None:
+            self._patchFrame(4, 5)
 
 
 class SerialNumberMessage(Message):
+    fields = (('SerialNumber', 0, '4s'),)
+
     def __init__(self, serial='\x00' * 4):
-        Message.__init__(self, type_=MESSAGE_SERIAL_NUMBER)
+        Message.__init__(self, type_=MESSAGE_SERIAL_NUMBER, payload='\x00' * 4)
         self.setSerialNumber(serial)
 
-    def getSerialNumber(self):
-        return self.getPayload()
-
-    def setSerialNumber(self, serial):
-        if (len(serial) != 4):
-            raise MessageError('Could not set serial number ' \
-                               '(expected 4 bytes).')
 
-        self.setPayload(serial)
+Message.handlers.update({
+    MESSAGE_CHANNEL_UNASSIGN: ChannelUnassignMessage,
+    MESSAGE_CHANNEL_ASSIGN: ChannelAssignMessage,
+    MESSAGE_CHANNEL_ID: ChannelIDMessage,
+    MESSAGE_CHANNEL_PERIOD: ChannelPeriodMessage,
+    MESSAGE_CHANNEL_SEARCH_TIMEOUT: ChannelSearchTimeoutMessage,
+    MESSAGE_CHANNEL_FREQUENCY: ChannelFrequencyMessage,
+    MESSAGE_CHANNEL_TX_POWER: ChannelTXPowerMessage,
+    MESSAGE_NETWORK_KEY: NetworkKeyMessage,
+    MESSAGE_TX_POWER: TXPowerMessage,
+    MESSAGE_STARTUP: StartupMessage,
+    MESSAGE_SYSTEM_RESET: SystemResetMessage,
+    MESSAGE_CHANNEL_OPEN: ChannelOpenMessage,
+    MESSAGE_CHANNEL_CLOSE: ChannelCloseMessage,
+    MESSAGE_CHANNEL_REQUEST: ChannelRequestMessage,
+    MESSAGE_CHANNEL_BROADCAST_DATA: ChannelBroadcastDataMessage,
+    MESSAGE_CHANNEL_ACKNOWLEDGED_DATA: ChannelAcknowledgedDataMessage,
+    MESSAGE_CHANNEL_BURST_DATA: ChannelBurstDataMessage,
+    MESSAGE_CHANNEL_EVENT: ChannelEventMessage,
+    MESSAGE_CHANNEL_STATUS: ChannelStatusMessage,
+    MESSAGE_VERSION: VersionMessage,
+    MESSAGE_CAPABILITIES: CapabilitiesMessage,
+    MESSAGE_SERIAL_NUMBER: SerialNumberMessage,
+})
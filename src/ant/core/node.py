@@ -23,7 +23,6 @@
 #
 ##############################################################################
 
-import time
 import thread
 import uuid
 
@@ -33,6 +32,14 @@ from ant.core import message
 from ant.core import event
 
 
+def _check(error):
+    def check(response):
+        if response.getMessageCode() != RESPONSE_NO_ERROR:
+            raise ChannelError(error)
+        return response
+    return check
+
+
 class NetworkKey(object):
     def __init__(self, name=None, key='\x00' * 8):
         self.key = key
@@ -44,123 +51,205 @@ class NetworkKey(object):
 
 
 class Channel(event.EventCallback):
-    cb_lock = thread.allocate_lock()
-
-    def __init__(self, node):
+    def __init__(self, node, number=0):
         self.node = node
         self.is_free = True
+        self.owner = None  # Whatever took the channel for good, if anything
         self.name = str(uuid.uuid4())
-        self.number = 0
-        self.cb = []
-        self.node.evm.registerCallback(self)
+        self.number = number
+        self.cb = ()
+        self.cb_lock = thread.allocate_lock()
+        # What Node.attach() found the channel set up as, if anything
+        self.state = CHANNEL_STATE_UNASSIGNED
+        self.network = None
+        self.type = None
+        self.device = None
+        self.node.evm.subscribe(self, message.ChannelMessage, number)
 
     def __del__(self):
         self.node.evm.removeCallback(self)
 
-    def assign(self, net_key, ch_type):
+    def assign(self, net_key, ch_type, block=True):
+        msg = self._assignMessage(net_key, ch_type)
+        future = self._command(msg, 'Could not assign channel.')
+        return self._finish(future.then(self._assigned), block)
+
+    def setID(self, dev_type, dev_num, trans_type, block=True):
+        msg = self._idMessage(dev_type, dev_num, trans_type)
+        future = self._command(msg, 'Could not set channel ID.')
+        return self._finish(future, block)
+
+    def setSearchTimeout(self, timeout, block=True):
+        msg = self._searchTimeoutMessage(timeout)
+        future = self._command(msg, 'Could not set channel search timeout.')
+        return self._finish(future, block)
+
+    def setPeriod(self, counts, block=True):
+        msg = self._periodMessage(counts)
+        future = self._command(msg, 'Could not set channel period.')
+        return self._finish(future, block)
+
+    def setFrequency(self, frequency, block=True):
+        msg = self._frequencyMessage(frequency)
+        future = self._command(msg, 'Could not set channel frequency.')
+        return self._finish(future, block)
+
+    def open(self, block=True):
+        msg = message.ChannelOpenMessage(number=self.number)
+        future = self._command(msg, 'Could not open channel.')
+        return self._finish(future, block)
+
+    def configure(self, net_key, ch_type, device=None, search_timeout=None,
+                  period=None, frequency=None, open_channel=True,
+                  block=True):
+        """Assign, set up and open the channel in a single round trip.
+
+        device is a (device type, device number, transmission type) tuple;
+        settings left as None are not sent. Every command is written at
+        once and the responses are collected as they arrive; if any step
+        fails, ConfigurationError lists each one that did.
+
+        """
+        steps = self._steps(net_key, ch_type, device, search_timeout,
+                            period, frequency, open_channel)
+        return self._finish(self.node._pipeline(steps), block)
+
+    def close(self, block=True):
+        closed = self.node.evm.expectEvent(self.number, EVENT_CHANNEL_CLOSED)
+        msg = message.ChannelCloseMessage(number=self.number)
+        try:
+            future = self._command(msg, 'Could not close channel.')
+        except:
+            closed.cancel()
+            raise
+
+        future = future.then(lambda response: closed)
+        future.addCallback(lambda f: f.error is not None and closed.cancel())
+        return self._finish(future, block)
+
+    def unassign(self, block=True):
+        msg = message.ChannelUnassignMessage(number=self.number)
+        future = self._command(msg, 'Could not unassign channel.')
+        return self._finish(future.then(self._unassigned), block)
+
+    def messages(self, maxsize=64):
+        """Return a MessageStream with this channel's incoming messages."""
+        stream = event.MessageStream(maxsize, self.number)
+        self.registerCallback(stream)
+        return stream
+
+    def _command(self, msg, error):
+        return self.node.evm.sendCommand(msg).then(_check(error))
+
+    def _steps(self, net_key, ch_type, device=None, search_timeout=None,
+               period=None, frequency=None, open_channel=True):
+        # (msg, error, what to do once it succeeded) for configure()
+        steps = [(self._assignMessage(net_key, ch_type),
+                  'Could not assign channel.', self._assigned)]
+        if device is not None:
+            steps.append((self._idMessage(*device),
+                          'Could not set channel ID.', None))
+        if search_timeout is not None:
+            steps.append((self._searchTimeoutMessage(search_timeout),
+                          'Could not set channel search timeout.', None))
+        if period is not None:
+            steps.append((self._periodMessage(period),
+                          'Could not set channel period.', None))
+        if frequency is not None:
+            steps.append((self._frequencyMessage(frequency),
+                          'Could not set channel frequency.', None))
+        if open_channel:
+            steps.append((message.ChannelOpenMessage(number=self.number),
+                          'Could not open channel.', None))
+        return steps
+
+    def _assignMessage(self, net_key, ch_type):
         msg = message.ChannelAssignMessage(number=self.number)
         msg.setNetworkNumber(self.node.getNetworkKey(net_key).number)
         msg.setChannelType(ch_type)
-        self.node.driver.write(msg.encode())
-        if self.node.evm.waitForAck(msg) != RESPONSE_NO_ERROR:
-            raise ChannelError('Could not assign channel.')
-        self.is_free = False
+        return msg
 
-    def setID(self, dev_type, dev_num, trans_type):
+    def _idMessage(self, dev_type, dev_num, trans_type):
         msg = message.ChannelIDMessage(number=self.number)
         msg.setDeviceType(dev_type)
         msg.setDeviceNumber(dev_num)
         msg.setTransmissionType(trans_type)
-        self.node.driver.write(msg.encode())
-        if self.node.evm.waitForAck(msg) != RESPONSE_NO_ERROR:
-            raise ChannelError('Could not set channel ID.')
+        return msg
 
-    def setSearchTimeout(self, timeout):
+    def _searchTimeoutMessage(self, timeout):
         msg = message.ChannelSearchTimeoutMessage(number=self.number)
         msg.setTimeout(timeout)
-        self.node.driver.write(msg.encode())
-        if self.node.evm.waitForAck(msg) != RESPONSE_NO_ERROR:
-            raise ChannelError('Could not set channel search timeout.')
+        return msg
 
-    def setPeriod(self, counts):
+    def _periodMessage(self, counts):
         msg = message.ChannelPeriodMessage(number=self.number)
         msg.setChannelPeriod(counts)
-        self.node.driver.write(msg.encode())
-        if self.node.evm.waitForAck(msg) != RESPONSE_NO_ERROR:
-            raise ChannelError('Could not set channel period.')
+        return msg
 
-    def setFrequency(self, frequency):
+    def _frequencyMessage(self, frequency):
         msg = message.ChannelFrequencyMessage(number=self.number)
         msg.setFrequency(frequency)
-        self.node.driver.write(msg.encode())
-        if self.node.evm.waitForAck(msg) != RESPONSE_NO_ERROR:
-            raise ChannelError('Could not set channel frequency.')
+        return msg
 
-    def open(self):
-        msg = message.ChannelOpenMessage(number=self.number)
-        self.node.driver.write(msg.encode())
-        if self.node.evm.waitForAck(msg) != RESPONSE_NO_ERROR:
-            raise ChannelError('Could not open channel.')
+    def _finish(self, future, block):
+        # Blocking calls keep returning nothing; the others get a Future.
+        if block:
+            future.wait()
+        else:
+            return future
 
-    def close(self):
-        msg = message.ChannelCloseMessage(number=self.number)
-        self.node.driver.write(msg.encode())
-        if self.node.evm.waitForAck(msg) != RESPONSE_NO_ERROR:
-            raise ChannelError('Could not close channel.')
+    def _assigned(self, response):
+        self.is_free = False
+        return response
 
-        while True:
-            msg = self.node.evm.waitForMessage(message.ChannelEventMessage)
-            if msg.getMessageCode() == EVENT_CHANNEL_CLOSED:
-                break
-
-    def unassign(self):
-        msg = message.ChannelUnassignMessage(number=self.number)
-        self.node.driver.write(msg.encode())
-        if self.node.evm.waitForAck(msg) != RESPONSE_NO_ERROR:
-            raise ChannelError('Could not unassign channel.')
-        self.is_free = True
+    def _unassigned(self, response):
+        self.is_free = self.owner is None
+        return response
 
     def registerCallback(self, callback):
         self.cb_lock.acquire()
         if callback not in self.cb:
-            self.cb.append(callback)
+            self.cb = self.cb + (callback,)
         self.cb_lock.release()
 
     def process(self, msg):
-        self.cb_lock.acquire()
-        if isinstance(msg, message.ChannelMessage) and \
-        msg.getChannelNumber() == self.number:
-            for callback in self.cb:
-                try:
-                    callback.process(msg)
-                except:
-                    pass  # Who cares?
-        self.cb_lock.release()
+        # The EventMachine only hands us this channel's messages
+        for callback in self.cb:
+            try:
+                callback.process(msg)
+            except:
+                pass  # Who cares?
 
 
 class Node(event.EventCallback):
-    node_lock = thread.allocate_lock()
-
     def __init__(self, driver):
         self.driver = driver
+        self.node_lock = thread.allocate_lock()
         self.evm = event.EventMachine(self.driver)
-        self.evm.registerCallback(self)
         self.networks = []
         self.channels = []
         self.running = False
         self.options = [0x00, 0x00, 0x00]
 
-    def start(self):
+    def start(self, warm=False):
+        """Start the node, resetting the stick unless warm is set; a warm
+        start attach()es to whatever the stick is already doing.
+
+        """
         if self.running:
             raise NodeError('Could not start ANT node (already started).')
 
         if not self.driver.isOpen():
             self.driver.open()
 
-        self.reset()
         self.evm.start()
+        if not warm:
+            self.reset()
         self.running = True
-        self.init()
+        if warm:
+            self.attach()
+        else:
+            self.init()
 
     def stop(self, reset=True):
         if not self.running:
@@ -173,19 +262,13 @@ class Node(event.EventCallback):
         self.driver.close()
 
     def reset(self):
-        msg = message.SystemResetMessage()
-        self.driver.write(msg.encode())
-        time.sleep(1)
+        self.evm.reset()
 
     def init(self):
         if not self.running:
             raise NodeError('Could not reset ANT node (not started).')
 
-        msg = message.ChannelRequestMessage()
-        msg.setMessageID(MESSAGE_CAPABILITIES)
-        self.driver.write(msg.encode())
-
-        caps = self.evm.waitForMessage(message.CapabilitiesMessage)
+        caps = self.evm.requestMessage(MESSAGE_CAPABILITIES).wait()
 
         self.networks = []
         for i in range(0, caps.getMaxNetworks()):
@@ -193,8 +276,50 @@ class Node(event.EventCallback):
             self.setNetworkKey(i)
         self.channels = []
         for i in range(0, caps.getMaxChannels()):
-            self.channels.append(Channel(self))
-            self.channels[i].number = i
+            self.channels.append(Channel(self, i))
+        self._setOptions(caps)
+
+    def attach(self):
+        """Rebuild networks and channels from the stick's current state
+        instead of resetting it, so open channels keep receiving.
+
+        Network keys can't be read back: networks get placeholder keys,
+        and are only sent to the stick again by setNetworkKey().
+
+        """
+        if not self.running:
+            raise NodeError('Could not attach to ANT node (not started).')
+
+        caps = self.evm.requestMessage(MESSAGE_CAPABILITIES).wait()
+
+        self.networks = []
+        for i in range(0, caps.getMaxNetworks()):
+            self.networks.append(NetworkKey())
+            self.networks[i].number = i
+
+        statuses = [self.evm.requestMessage(MESSAGE_CHANNEL_STATUS, i)
+                    for i in range(0, caps.getMaxChannels())]
+        ids = {}
+        self.channels = []
+        for i, status in enumerate(statuses):
+            status = status.wait()
+            channel = Channel(self, i)
+            channel.state = status.getChannelState()
+            if channel.state != CHANNEL_STATE_UNASSIGNED:
+                channel.is_free = False
+                channel.network = self.networks[status.getNetworkNumber()]
+                channel.type = status.getChannelType()
+                ids[i] = self.evm.requestMessage(MESSAGE_CHANNEL_ID, i)
+            self.channels.append(channel)
+
+        for i, future in ids.items():
+            id_ = future.wait()
+            self.channels[i].device = (id_.getDeviceType(),
+                                       id_.getDeviceNumber(),
+                                       id_.getTransmissionType())
+        self._setOptions(caps)
+
+    def _setOptions(self, caps):
         self.options = (caps.getStdOptions(),
                         caps.getAdvOptions(),
                         caps.getAdvOptions2(),)
@@ -211,8 +336,7 @@ class Node(event.EventCallback):
         msg = message.NetworkKeyMessage()
         msg.setNumber(number)
         msg.setKey(self.networks[number].key)
-        self.driver.write(msg.encode())
-        self.evm.waitForAck(msg)
+        self.evm.sendCommand(msg).wait()
         self.networks[number].number = number
 
     def getNetworkKey(self, name):
@@ -222,11 +346,82 @@ class Node(event.EventCallback):
         raise NodeError('Could not find network key with the supplied name.')
 
     def getFreeChannel(self):
-        for channel in self.channels:
-            if channel.is_free:
-                return channel
+        self.node_lock.acquire()
+        try:
+            for channel in self.channels:
+                if channel.is_free:
+                    return channel
+        finally:
+            self.node_lock.release()
         raise NodeError('Could not find free channel.')
 
+    def configureChannels(self, configs, block=True):
+        """Configure a free channel for each dict of Channel.configure()
+        arguments in configs, pipelining every command to the stick.
+
+        Returns the channels, in order (a Future for them if not block).
+        If any step fails, ConfigurationError lists each one that did.
+
+        """
+        # Reserve the channels before anything is sent, so no other caller
+        # picks them too
+        self.node_lock.acquire()
+        try:
+            channels = [channel for channel in self.channels
+                        if channel.is_free][:len(configs)]
+            if len(channels) < len(configs):
+                raise NodeError('Could not find enough free channels.')
+            for channel in channels:
+                channel.is_free = False
+        finally:
+            self.node_lock.release()
+
+        def release(done):
+            # Channels that didn't get assigned are free again
+            if done.error is not None:
+                failed = [number for number, type_, error
+                          in getattr(done.error, 'errors', ())
+                          if type_ == MESSAGE_CHANNEL_ASSIGN]
+                for channel in channels:
+                    if channel.number in failed:
+                        channel.is_free = True
+
+        steps = []
+        for channel, config in zip(channels, configs):
+            steps += channel._steps(**config)
+        try:
+            future = self._pipeline(steps)
+        except:
+            for channel in channels:
+                channel.is_free = True
+            raise
+        future.addCallback(release)
+        future = future.then(lambda result: channels)
+        if block:
+            return future.wait()
+        return future
+
+    def _pipeline(self, steps):
+        # One write for every command; each response is checked on its own
+        futures = self.evm.sendCommands([msg for msg, error, post in steps])
+        checked = []
+        for (msg, error, post), future in zip(steps, futures):
+            future = future.then(_check(error))
+            if post is not None:
+                future = future.then(post)
+            checked.append(future)
+
+        def report(done):
+            errors = [(msg.getChannelNumber(), msg.getType(), future.error)
+                      for (msg, error, post), future in zip(steps, done)
+                      if future.error is not None]
+            if errors:
+                raise ConfigurationError(
+                    'Could not configure channels (%d steps failed).' %
+                    len(errors), errors)
+
+        return event.Future.gather(checked).then(report)
+
     def registerEventListener(self, callback):
         self.evm.registerCallback(callback)
 
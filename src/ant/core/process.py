@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2011, Martín Raúl Villalba
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+##############################################################################
+
+import ctypes
+import multiprocessing
+import threading
+from multiprocessing.sharedctypes import RawArray
+
+from ant.core.driver import Driver
+from ant.core.event import Framer, PUMP_TIMEOUT, PUMP_READ_SIZE
+from ant.core.event import WAIT_TIMEOUT, HAS_MEMORYVIEW
+from ant.core.exceptions import DriverError
+
+# FrameRing.state slots
+HEAD = 0
+TAIL = 1
+DROPPED = 2
+
+
+class FrameRing(object):
+    """A single-producer, single-consumer byte ring in shared memory.
+
+    The producer only ever puts whole frames and drops (and counts) a frame
+    that does not fit, so the consumer never waits on a partial one. HEAD
+    and TAIL are running byte counts; the producer stores the data before
+    moving HEAD and the consumer copies it out before moving TAIL.
+
+    """
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.data = RawArray('c', capacity)
+        self.state = RawArray(ctypes.c_uint64, 3)
+
+    def pending(self):
+        return self.state[HEAD] - self.state[TAIL]
+
+    def dropped(self):
+        return self.state[DROPPED]
+
+    def put(self, frame):
+        size = len(frame)
+        head = self.state[HEAD]
+        if self.capacity - (head - self.state[TAIL]) < size:
+            self.state[DROPPED] += 1
+            return False
+
+        start = head % self.capacity
+        first = min(size, self.capacity - start)
+        self.data[start:start + first] = frame[:first]
+        if first < size:
+            self.data[0:size - first] = frame[first:]
+        self.state[HEAD] = head + size
+        return True
+
+    def readinto(self, buffer_):
+        tail = self.state[TAIL]
+        count = min(len(buffer_), self.state[HEAD] - tail)
+        start = tail % self.capacity
+        first = min(count, self.capacity - start)
+        buffer_[0:first] = buffer(self.data, start, first)
+        if first < count:
+            buffer_[first:count] = buffer(self.data, 0, count - first)
+        self.state[TAIL] = tail + count
+        return count
+
+
+def _serve(driver, ring, notify, commands, stop):
+    # Child process: open the real driver, frame what it reads into the
+    # ring and write whatever the parent sends.
+    def write():
+        try:
+            while True:
+                driver.write(commands.recv_bytes())
+        except (EOFError, DriverError):
+            pass
+
+    try:
+        driver.open()
+    except DriverError, e:
+        notify.send_bytes(str(e))
+        return
+    notify.send_bytes('')
+
+    writer = threading.Thread(target=write)
+    writer.setDaemon(True)
+    writer.start()
+
+    # If the stick goes away, exit: the parent sees the pipe close
+    framer = Framer()
+    try:
+        while not stop.is_set():
+            if not driver.wait(PUMP_TIMEOUT):
+                continue
+
+            count = driver.available() or driver.read_size or PUMP_READ_SIZE
+            if HAS_MEMORYVIEW:
+                count = driver.readinto(framer.reserve(count))
+                messages = framer.commit(count)
+            else:
+                messages = framer.feed(driver.read(count))
+            published = False
+            for msg in messages:
+                published = ring.put(msg.encode()) or published
+            if published:
+                notify.send_bytes('')
+    except (DriverError, IOError, OSError):
+        pass
+
+    try:
+        driver.close()
+    except DriverError:
+        pass
+
+
+class ProcessDriver(Driver):
+    """Run another driver, and the framing of what it reads, in a child
+    process.
+
+    The child keeps reading the stick on time however long the parent's
+    threads hold the GIL, and hands over validated frames through a
+    FrameRing in shared memory; the parent's pump reads them like any
+    other driver, without pickling. Writes go to the child over a pipe.
+    The wrapped driver must not be open yet.
+
+    """
+    def __init__(self, driver, capacity=65536, log=None, debug=False):
+        Driver.__init__(self, driver.device, log, debug)
+        self.driver = driver
+        self.capacity = capacity
+        self.ring = None
+
+    def dropped(self):
+        """Frames the child had to drop because the ring was full."""
+        if self.ring is None:
+            return 0
+        return self.ring.dropped()
+
+    def _open(self):
+        self.ring = FrameRing(self.capacity)
+        self._notify, notify = multiprocessing.Pipe(False)
+        commands, self._commands = multiprocessing.Pipe(False)
+        self._stop = multiprocessing.Event()
+        self._process = multiprocessing.Process(
+            target=_serve,
+            args=(self.driver, self.ring, notify, commands, self._stop))
+        self._process.daemon = True
+        self._process.start()
+        notify.close()
+        commands.close()
+
+        if not self._notify.poll(WAIT_TIMEOUT):
+            self._shutdown()
+            raise DriverError('Could not open device (no answer).')
+        error = self._notify.recv_bytes()
+        if error:
+            self._shutdown()
+            raise DriverError(error)
+
+    def _close(self):
+        self._shutdown()
+
+    def _shutdown(self):
+        self._stop.set()
+        self._process.join(WAIT_TIMEOUT)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._notify.close()
+        self._commands.close()
+
+    def _read(self, count):
+        buffer_ = bytearray(count)
+        return str(buffer_[0:self._readinto(buffer_)])
+
+    def _readinto(self, buffer_):
+        try:
+            while self._notify.poll():
+                self._notify.recv_bytes()
+        except (EOFError, IOError):
+            # The child is gone; hand over what it left in the ring first
+            if not self.ring.pending():
+                raise DriverError('Could not read from device (child '
+                                  'process exited).')
+        return self.ring.readinto(buffer_)
+
+    def _write(self, data):
+        try:
+            self._commands.send_bytes(data)
+        except (EOFError, IOError):
+            raise DriverError('Could not write to device (child process '
+                              'exited).')
+        return len(data)
+
+    def _wait(self, timeout):
+        if self.ring.pending():
+            return True
+        try:
+            return self._notify.poll(timeout)
+        except (EOFError, IOError):
+            return True  # Let the read report it
+
+    def _fileno(self):
+        return self._notify.fileno()
+
+    def _available(self):
+        return self.ring.pending()
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2011, Martín Raúl Villalba
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+##############################################################################
+
+import thread
+import threading
+import time
+import uuid
+
+from ant.core.constants import *
+from ant.core import event
+from ant.core import message
+
+# How often ChannelScheduler.start() runs tick()
+SCHEDULER_INTERVAL = 0.1
+# How long a channel may take to open, or close and unassign, before its
+# commands are given up on and the channel is freed anyway
+SCHEDULER_TIMEOUT = 5.0
+
+# Slot states
+SLOT_IDLE = 0
+SLOT_OPENING = 1
+SLOT_OPEN = 2
+SLOT_CLOSING = 3
+
+
+class Sensor(event.EventCallback):
+    """A device to receive from, on whichever channel is free.
+
+    period and search_timeout are in the stick's units (1/32768 s and
+    2.5 s). latency is how old the sensor's data was when it was last
+    refreshed and max_latency the worst so far; misses counts the visits
+    on which the sensor wasn't found.
+
+    """
+    def __init__(self, device_type, device_number, trans_type=0x00,
+                 period=8192, frequency=57, search_timeout=2, name=None):
+        self.device = (device_type, device_number, trans_type)
+        self.period = period
+        self.frequency = frequency
+        self.search_timeout = search_timeout
+        if name:
+            self.name = name
+        else:
+            self.name = str(uuid.uuid4())
+        self.slot = None
+        self.cb = ()
+        self.cb_lock = thread.allocate_lock()
+        self.last_visit = time.time()
+        self.last_update = None
+        self.updates = 0
+        self.misses = 0
+        self.latency = None
+        self.max_latency = 0.0
+
+    def getStaleness(self, now):
+        # Time since the sensor last had a channel, found or not
+        return now - self.last_visit
+
+    def registerCallback(self, callback):
+        self.cb_lock.acquire()
+        if callback not in self.cb:
+            self.cb = self.cb + (callback,)
+        self.cb_lock.release()
+
+    def process(self, msg):
+        now = time.time()
+        if self.last_update is not None:
+            self.latency = now - self.last_update
+            self.max_latency = max(self.max_latency, self.latency)
+        self.last_update = now
+        self.updates += 1
+
+        for callback in self.cb:
+            try:
+                callback.process(msg)
+            except:
+                pass
+
+
+class _Slot(event.EventCallback):
+    # A hardware channel and the sensor it is serving, if any
+    data = (message.ChannelBroadcastDataMessage,
+            message.ChannelAcknowledgedDataMessage,
+            message.ChannelBurstDataMessage)
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.sensor = None
+        self.state = SLOT_IDLE
+        self.since = 0  # When the slot entered its current state
+        self.started = 0
+        self.updates = 0
+        # Bumped on every state change, so callbacks from commands that
+        # were given up on are ignored
+        self.generation = 0
+        self.future = None
+
+    def process(self, msg):
+        sensor = self.sensor
+        if sensor is not None and self.state == SLOT_OPEN and \
+        isinstance(msg, self.data):
+            self.updates += 1
+            sensor.process(msg)
+
+
+class ChannelScheduler(object):
+    """Share a node's channels between more sensors than it has.
+
+    Free channels go to the sensors that have gone longest without one.
+    While sensors are waiting for a channel, one that has delivered dwell
+    updates, or has not been found within its search timeout, gives up its
+    channel to the next in line. With no more sensors than channels,
+    nothing rotates. A channel that doesn't open, or close, within timeout
+    seconds is freed anyway. Call tick() regularly, or start() a thread
+    that does.
+
+    """
+    def __init__(self, node, net_key, channels=None, dwell=1,
+                 ch_type=CHANNEL_TYPE_TWOWAY_RECEIVE,
+                 timeout=SCHEDULER_TIMEOUT):
+        self.node = node
+        self.net_key = net_key
+        self.dwell = dwell
+        self.timeout = timeout
+        self.ch_type = ch_type
+        # Take the channels for good, so the node never hands them out
+        node.node_lock.acquire()
+        try:
+            if channels is None:
+                channels = [c for c in node.channels if c.is_free]
+            for channel in channels:
+                channel.is_free = False
+                channel.owner = self
+        finally:
+            node.node_lock.release()
+        self.slots = []
+        self.free = []
+        for channel in channels:
+            slot = _Slot(channel)
+            channel.registerCallback(slot)
+            self.slots.append(slot)
+            self.free.append(slot)
+        self.sensors = []
+        # Reentrant: futures that are already done call back right away
+        self.lock = threading.RLock()
+        self.running = False
+        self.worker = None
+
+    def add(self, sensor):
+        self.lock.acquire()
+        if sensor not in self.sensors:
+            self.sensors.append(sensor)
+        self.lock.release()
+
+    def remove(self, sensor):
+        self.lock.acquire()
+        if sensor in self.sensors:
+            self.sensors.remove(sensor)
+            if sensor.slot is not None:
+                self._release(sensor.slot)
+        self.lock.release()
+
+    def report(self):
+        """Return (name, updates, misses, latency, max latency) for every
+        sensor.
+
+        """
+        self.lock.acquire()
+        try:
+            return [(s.name, s.updates, s.misses, s.latency, s.max_latency)
+                    for s in self.sensors]
+        finally:
+            self.lock.release()
+
+    def tick(self, now=None):
+        if now is None:
+            now = time.time()
+
+        self.lock.acquire()
+        try:
+            for slot in self.slots:
+                if slot.state in (SLOT_OPENING, SLOT_CLOSING) and \
+                now - slot.since > self.timeout:
+                    self._giveUp(slot, now)
+
+            waiting = [s for s in self.sensors if s.slot is None]
+            for slot in self.slots:
+                if slot.state == SLOT_OPEN and slot.updates == 0 and \
+                now - slot.started > slot.sensor.search_timeout * 2.5:
+                    slot.sensor.misses += 1
+                    self._release(slot)
+
+            # Rotate served sensors out while others wait for a channel
+            closing = len([s for s in self.slots
+                           if s.state == SLOT_CLOSING])
+            demand = len(waiting) - len(self.free) - closing
+            served = [s for s in self.slots
+                      if s.state == SLOT_OPEN and s.updates >= self.dwell]
+            served.sort(key=lambda s: s.started)
+            for slot in served[:max(demand, 0)]:
+                self._release(slot)
+
+            waiting.sort(key=lambda s: s.getStaleness(now), reverse=True)
+            for sensor in waiting[:len(self.free)]:
+                self._assign(self.free.pop(0), sensor, now)
+        finally:
+            self.lock.release()
+
+    def start(self, interval=SCHEDULER_INTERVAL):
+        self.running = True
+        self.worker = threading.Thread(target=self._run, args=(interval,))
+        self.worker.setDaemon(True)
+        self.worker.start()
+
+    def stop(self):
+        self.running = False
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+
+    def _run(self, interval):
+        while self.running:
+            self.tick()
+            time.sleep(interval)
+
+    def _assign(self, slot, sensor, now):
+        self._enter(slot, SLOT_OPENING, now)
+        slot.sensor = sensor
+        slot.started = now
+        slot.updates = 0
+        sensor.slot = slot
+        generation = slot.generation
+        try:
+            slot.future = slot.channel.configure(
+                self.net_key, self.ch_type, device=sensor.device,
+                search_timeout=sensor.search_timeout, period=sensor.period,
+                frequency=sensor.frequency, block=False)
+        except:
+            self._release(slot)
+            return
+        slot.future.addCallback(
+            lambda f: self._opened(slot, generation, f))
+
+    def _opened(self, slot, generation, future):
+        self.lock.acquire()
+        if slot.generation == generation:
+            if future.error is None:
+                self._enter(slot, SLOT_OPEN)
+                slot.started = slot.since
+            else:
+                self._release(slot)
+        self.lock.release()
+
+    def _release(self, slot, now=None):
+        # Close and unassign whatever got set up, then free the slot
+        def unassign(closed):
+            self.lock.acquire()
+            try:
+                if slot.generation == generation:
+                    try:
+                        slot.future = slot.channel.unassign(block=False)
+                        slot.future.addCallback(freed)
+                    except:
+                        self._free(slot)
+            finally:
+                self.lock.release()
+
+        def freed(unassigned):
+            self.lock.acquire()
+            if slot.generation == generation:
+                self._free(slot)
+            self.lock.release()
+
+        if slot.sensor is not None:
+            slot.sensor.slot = None
+            slot.sensor.last_visit = time.time()
+        slot.sensor = None
+        self._enter(slot, SLOT_CLOSING, now)
+        generation = slot.generation
+        try:
+            slot.future = slot.channel.close(block=False)
+            slot.future.addCallback(unassign)
+        except:
+            unassign(None)
+
+    def _giveUp(self, slot, now):
+        # A response got lost: stop waiting for it. A channel that didn't
+        # open is still closed and unassigned; one that didn't close is
+        # freed as it is, and the next configure() sorts it out.
+        future = slot.future
+        if slot.state == SLOT_OPENING:
+            self._release(slot, now)
+        else:
+            self._free(slot)
+        if future is not None:
+            future.cancel()
+
+    def _enter(self, slot, state, now=None):
+        if now is None:
+            now = time.time()
+        slot.state = state
+        slot.since = now
+        slot.generation += 1
+        slot.future = None
+
+    def _free(self, slot):
+        self._enter(slot, SLOT_IDLE)
+        self.free.append(slot)
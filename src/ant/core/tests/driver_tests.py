@@ -23,9 +23,15 @@
 #
 ##############################################################################
 
+import os
+import threading
+import time
+import tty
 import unittest
 
 from ant.core.driver import *
+from ant.core import message
+from ant.core.event import HAS_MEMORYVIEW
 
 
 class DummyDriver(Driver):
@@ -42,6 +48,35 @@ class DummyDriver(Driver):
         return len(data)
 
 
+class DummyLog(object):
+    def __init__(self):
+        self.writes = []
+
+    def logOpen(self):
+        pass
+
+    def logClose(self):
+        pass
+
+    def logRead(self, data):
+        pass
+
+    def logWrite(self, data):
+        self.writes.append(data)
+
+
+class BlockingDriver(DummyDriver):
+    def __init__(self, device, log=None, debug=False):
+        DummyDriver.__init__(self, device, log, debug)
+        self.reading = threading.Event()
+        self.release = threading.Event()
+
+    def _read(self, count):
+        self.reading.set()
+        self.release.wait(1)
+        return '\x00' * count
+
+
 class DriverTest(unittest.TestCase):
     def setUp(self):
         self.driver = DummyDriver('superdrive')
@@ -73,6 +108,21 @@ class DriverTest(unittest.TestCase):
         self.assertRaises(DriverError, self.driver.read, 0)
         self.driver.close()
 
+    def test_readinto(self):
+        buffer_ = bytearray('\xFF' * 8)
+        self.assertRaises(DriverError, self.driver.readinto, buffer_)
+        self.driver.open()
+        self.assertEquals(self.driver.readinto(buffer_), 8)
+        self.assertEquals(buffer_, bytearray('\x00' * 8))
+        if HAS_MEMORYVIEW:
+            buffer_ = bytearray('\xFF' * 8)
+            self.assertEquals(
+                self.driver.readinto(memoryview(buffer_)[2:6]), 4)
+            self.assertEquals(buffer_, bytearray('\xFF\xFF\x00\x00\x00\x00'
+                                                 '\xFF\xFF'))
+        self.assertRaises(DriverError, self.driver.readinto, bytearray())
+        self.driver.close()
+
     def test_write(self):
         self.assertRaises(DriverError, self.driver.write, '\xFF')
         self.driver.open()
@@ -80,6 +130,54 @@ class DriverTest(unittest.TestCase):
         self.assertEquals(self.driver.write('\xFF' * 10), 10)
         self.driver.close()
 
+    def test_wait_available(self):
+        self.assertFalse(self.driver.wait(0))
+        self.assertEquals(self.driver.available(), 0)
+        self.driver.open()
+        self.assertTrue(self.driver.wait(0))
+        self.assertEquals(self.driver.available(), 0)
+        self.driver.close()
+
+    def test_writeMessages(self):
+        log = DummyLog()
+        self.driver = DummyDriver('superdrive', log=log)
+        self.driver.open()
+        messages = [message.ChannelPeriodMessage(number=i) for i in range(3)]
+        self.assertEquals(self.driver.writeMessages(messages), 3 * 7)
+        self.assertEquals(log.writes, [msg.encode() for msg in messages])
+        self.driver.close()
+
+    def test_lock_per_instance(self):
+        # One stick's blocked read must not hold up another stick
+        other = DummyDriver('otherdrive')
+        other.open()
+        self.driver._read_lock.acquire()
+        self.driver._write_lock.acquire()
+        try:
+            self.assertEquals(other.write('\xFF'), 1)
+        finally:
+            self.driver._write_lock.release()
+            self.driver._read_lock.release()
+        other.close()
+
+    def test_write_latency(self):
+        # Writes go straight through while a read is blocked on the device
+        def read():
+            self.driver.read(1)
+
+        self.driver = BlockingDriver('superdrive', log=DummyLog())
+        self.driver.open()
+        reader = threading.Thread(target=read)
+        reader.start()
+        self.driver.reading.wait(1)
+        start = time.time()
+        self.driver.write('\xFF')
+        latency = time.time() - start
+        self.driver.release.set()
+        reader.join()
+        self.assertTrue(latency < 0.05)
+        self.driver.close()
+
 
 # How do you even test this without hardware?
 class USB1DriverTest(unittest.TestCase):
@@ -94,3 +192,23 @@ class USB1DriverTest(unittest.TestCase):
 
     def _write(self):
         pass
+
+    if hasattr(os, 'openpty'):
+        def test_available(self):
+            # A pseudo-terminal stands in for the stick's serial port
+            master, slave = os.openpty()
+            tty.setraw(master)
+            driver = USB1Driver(os.ttyname(slave), max_chunk=32)
+            driver.open()
+            try:
+                os.write(master, '\xA4' * 100)
+                self.assertTrue(driver.wait(1))
+                time.sleep(0.05)
+                self.assertEquals(driver.available(), 32)
+                buffer_ = bytearray(100)
+                self.assertEquals(driver.readinto(buffer_), 100)
+                self.assertEquals(driver.available(), 0)
+            finally:
+                driver.close()
+                os.close(master)
+                os.close(slave)
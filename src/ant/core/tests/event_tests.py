@@ -23,8 +23,571 @@
 #
 ##############################################################################
 
+import os
+import thread
+import threading
+import time
 import unittest
 
+from ant.core import event
+from ant.core.driver import Driver
+from ant.core.exceptions import DriverError
 from ant.core.event import *
+from ant.core.constants import *
+from ant.core.message import *
+
+from fakes import QueueDriver
 
 #TODO: How exactly do you properly test threaded code?
+
+
+class FramerTest(unittest.TestCase):
+    def setUp(self):
+        self.framer = Framer(capacity=16)
+        self.raw = ''.join(
+            ChannelEventMessage(number=i, message_code=i).encode()
+            for i in range(10))
+
+    def test_feed(self):
+        messages = self.framer.feed(self.raw)
+        self.assertEquals(len(messages), 10)
+        self.assertTrue(isinstance(messages[3], ChannelEventMessage))
+        self.assertEquals(messages[3].getChannelNumber(), 3)
+        self.assertEquals(len(self.framer), 0)
+
+    def test_feed_chunked(self):
+        messages = []
+        for i in range(0, len(self.raw), 3):
+            messages += self.framer.feed(self.raw[i:i + 3])
+        self.assertEquals([msg.getMessageCode() for msg in messages],
+                          range(10))
+        self.assertEquals(len(self.framer.buffer), 16)
+
+    def test_reserve(self):
+        # Reading straight into the buffer, as the pump does
+        if not HAS_MEMORYVIEW:
+            return
+        messages = []
+        for i in range(0, len(self.raw), 5):
+            chunk = self.raw[i:i + 5]
+            view = self.framer.reserve(8)
+            view[0:len(chunk)] = chunk
+            del view
+            messages += self.framer.commit(len(chunk))
+        self.assertEquals([msg.getMessageCode() for msg in messages],
+                          range(10))
+        self.assertEquals(len(self.framer.buffer), 16)
+
+    def test_partial(self):
+        self.assertEquals(len(self.framer.feed(self.raw[:10])), 1)
+        self.assertEquals(len(self.framer), 3)
+        self.assertEquals(len(self.framer.feed(self.raw[10:])), 9)
+
+    def test_bad_checksum(self):
+        raw = '\xA4\x03\x40\x01\x00\x00\x00' + self.raw[:7]
+        messages = self.framer.feed(raw)
+        self.assertEquals(len(messages), 1)
+        self.assertEquals(messages[0].getChannelNumber(), 0)
+        self.assertEquals(self.framer.checksum_errors, 1)
+        self.assertEquals(self.framer.dropped_bytes, 7)
+
+    def test_resync(self):
+        noise = '\x00\xFF\xA4\xA4\x20\x13'
+        messages = self.framer.feed(noise + self.raw[:14] + noise +
+                                    self.raw[14:])
+        self.assertEquals([msg.getMessageCode() for msg in messages],
+                          range(10))
+        self.assertEquals(self.framer.dropped_bytes, 2 * len(noise))
+        self.assertTrue(self.framer.resyncs > 0)
+        self.assertEquals(len(self.framer), 0)
+
+    def test_resync_bounded(self):
+        for i in range(1000):
+            self.framer.feed('\x13\x37' * 8)
+        self.assertTrue(len(self.framer) < 5)
+        self.assertEquals(len(self.framer.buffer), 16)
+        self.assertEquals(self.framer.feed(self.raw)[0].getMessageCode(), 0)
+
+    def test_no_resync(self):
+        self.framer = Framer(resync=False)
+        self.assertEquals(self.framer.feed('\x00' + self.raw), [])
+        self.assertEquals(len(self.framer), len(self.raw) + 1)
+
+
+class ProcessBufferTest(unittest.TestCase):
+    def test_ProcessBuffer(self):
+        raw = ChannelEventMessage().encode()
+        self.assertEquals(ProcessBuffer(''), ('', []))
+        buffer_, messages = ProcessBuffer(raw * 2 + raw[:3])
+        self.assertEquals(buffer_, raw[:3])
+        self.assertEquals(len(messages), 2)
+
+    def test_single_frame(self):
+        raw = ChannelEventMessage().encode()
+        buffer_, messages = ProcessBuffer(raw)
+        self.assertEquals(buffer_, '')
+        self.assertEquals(len(messages), 1)
+
+
+class FutureTest(unittest.TestCase):
+    def test_resolve(self):
+        future = Future()
+        results = []
+        future.addCallback(lambda f: results.append(f.result))
+        self.assertTrue(future.resolve(1))
+        self.assertFalse(future.resolve(2))
+        self.assertEquals(future.wait(0), 1)
+        future.addCallback(lambda f: results.append(f.result))
+        self.assertEquals(results, [1, 1])
+
+    def test_fail(self):
+        future = Future()
+        future.fail(ValueError('test'))
+        self.assertRaises(ValueError, future.wait, 0)
+
+    def test_then(self):
+        first = Future()
+        inner = Future()
+        chained = first.then(lambda x: x + 1)
+        flattened = first.then(lambda x: inner)
+        failed = first.then(lambda x: 1 / 0)
+        first.resolve(1)
+        self.assertEquals(chained.wait(0), 2)
+        self.assertFalse(flattened.isDone())
+        inner.resolve(5)
+        self.assertEquals(flattened.wait(0), 5)
+        self.assertRaises(ZeroDivisionError, failed.wait, 0)
+
+    def test_cancel(self):
+        discarded = []
+        first = Future(discard=discarded.append)
+        chained = first.then(lambda x: x)
+        self.assertRaises(TimeoutError, chained.wait, 0.01)
+        self.assertEquals(discarded, [first])
+        self.assertRaises(TimeoutError, first.wait, 0)
+
+
+class MessageStreamTest(unittest.TestCase):
+    def test_stream(self):
+        stream = MessageStream(maxsize=2, number=1)
+        stream.process(ChannelEventMessage(number=0))
+        stream.process(CapabilitiesMessage())
+        for i in range(3):
+            stream.process(ChannelEventMessage(number=1, message_code=i))
+        self.assertEquals(stream.dropped, 1)
+        self.assertEquals(stream.get(0).getMessageCode(), 0)
+        self.assertEquals(iter(stream).next().getMessageCode(), 1)
+        self.assertEquals(stream.poll(), None)
+        self.assertRaises(TimeoutError, stream.get, 0.01)
+
+
+class RingQueueTest(unittest.TestCase):
+    def fill(self, queue, count):
+        for i in range(count):
+            queue.put(ChannelEventMessage(message_code=i))
+
+    def codes(self, queue):
+        codes = []
+        while len(queue):
+            codes.append(queue.take(lambda msg: True).getMessageCode())
+        return codes
+
+    def test_drop_oldest(self):
+        queue = RingQueue(3)
+        self.fill(queue, 5)
+        self.assertEquals(queue.dropped, 2)
+        self.assertEquals(self.codes(queue), [2, 3, 4])
+
+    def test_drop_newest(self):
+        queue = RingQueue(3, OVERFLOW_DROP_NEWEST)
+        self.fill(queue, 5)
+        self.assertEquals(queue.dropped, 2)
+        self.assertEquals(queue.peak, 3)
+        self.assertEquals(self.codes(queue), [0, 1, 2])
+
+    def test_block(self):
+        def consume():
+            time.sleep(0.1)
+            taken.append(queue.take(lambda msg: True, 1))
+            consumed.set()
+
+        taken = []
+        consumed = threading.Event()
+        queue = RingQueue(1, OVERFLOW_BLOCK, block_timeout=2)
+        self.fill(queue, 1)
+        thread.start_new_thread(consume, ())
+        self.assertTrue(queue.put(ChannelEventMessage(message_code=1)))
+        consumed.wait(2)
+        self.assertEquals(taken[0].getMessageCode(), 0)
+
+        queue.block_timeout = 0.01
+        self.assertFalse(queue.put(ChannelEventMessage()))
+        self.assertEquals(queue.dropped, 1)
+
+    def test_one_timer(self):
+        # Wakeups for messages that don't match don't start more timers
+        def post():
+            for i in range(5):
+                time.sleep(0.01)
+                queue.put(ChannelEventMessage(message_code=i))
+
+        timers = []
+        timer = threading.Timer
+        threading.Timer = lambda *args: timers.append(args) or timer(*args)
+        queue = RingQueue(8)
+        thread.start_new_thread(post, ())
+        try:
+            msg = queue.take(lambda msg: msg.getMessageCode() == 4, 1)
+        finally:
+            threading.Timer = timer
+        self.assertEquals(msg.getMessageCode(), 4)
+        self.assertEquals(len(timers), 1)
+        self.assertEquals(queue.waiters, 0)
+
+    def test_spill(self):
+        queue = RingQueue(2, OVERFLOW_SPILL)
+        self.fill(queue, 6)
+        self.assertEquals((queue.dropped, queue.spilled), (0, 4))
+        self.assertEquals(len(queue), 6)
+        msg = queue.take(lambda msg: msg.getMessageCode() == 1)
+        self.assertTrue(isinstance(msg, ChannelEventMessage))
+        self.assertEquals(self.codes(queue), [0, 2, 3, 4, 5])
+        self.assertRaises(TimeoutError, queue.take, lambda msg: True, 0.01)
+
+    def test_spill_limit(self):
+        size = len(ChannelEventMessage().encode())
+        queue = RingQueue(2, OVERFLOW_SPILL, spill_limit=3 * size)
+        self.fill(queue, 7)
+        self.assertEquals((queue.dropped, queue.spilled), (2, 5))
+        self.assertEquals(self.codes(queue), [2, 3, 4, 5, 6])
+
+        # Holes left by take() are compacted away
+        self.fill(queue, 5)
+        queue.take(lambda msg: msg.getMessageCode() == 1)
+        self.fill(queue, 20)
+        self.assertTrue(queue.spill_end <= 2 * 3 * size)
+        self.assertEquals(self.codes(queue), [15, 16, 17, 18, 19])
+
+    def test_spill_read_once(self):
+        def put():
+            for i in range(4, 8):
+                time.sleep(0.02)
+                queue.put(ChannelEventMessage(message_code=i))
+
+        seen = []
+
+        def match(msg):
+            seen.append(msg.getMessageCode())
+            return False
+
+        queue = RingQueue(1, OVERFLOW_SPILL)
+        self.fill(queue, 4)
+        thread.start_new_thread(put, ())
+        self.assertRaises(TimeoutError, queue.take, match, 0.3)
+        # 0-2 were spilled all along; the others were in memory for a while
+        for code in range(3):
+            self.assertEquals(seen.count(code), 1)
+        self.assertTrue(seen.count(3) > 1)
+
+
+class RecordingCallback(EventCallback):
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.seen = []
+        self.done = threading.Event()
+
+    def process(self, msg):
+        time.sleep(self.delay)
+        if not isinstance(msg, ChannelEventMessage):
+            self.seen.append(msg.getType())
+            return
+        self.seen.append(msg.getMessageCode())
+        if msg.getMessageCode() == 0xFF:
+            self.done.set()
+
+
+class DispatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = Dispatcher(workers=2, maxsize=4, batch=2)
+
+    def tearDown(self):
+        self.dispatcher.stop()
+
+    def test_order(self):
+        callbacks = [RecordingCallback() for i in range(3)]
+        for code in range(10) + [0xFF]:
+            for callback in callbacks:
+                self.dispatcher.submit(callback, ChannelEventMessage(
+                    message_code=code))
+            time.sleep(0.001)
+        for callback in callbacks:
+            self.assertTrue(callback.done.wait(1) or callback.done.isSet())
+            self.assertEquals(callback.seen, range(10) + [0xFF])
+        self.assertEquals(self.dispatcher.depth(), 0)
+
+    def test_overflow(self):
+        # A slow subscriber loses its oldest messages, not the newest
+        callback = RecordingCallback(delay=0.05)
+        for code in range(8) + [0xFF]:
+            self.dispatcher.submit(callback, ChannelEventMessage(
+                message_code=code))
+        callback.done.wait(2)
+        subscriber = self.dispatcher.subscribers[callback]
+        self.assertTrue(subscriber.dropped >= 4)
+        self.assertEquals(callback.seen[-1], 0xFF)
+        self.assertEquals(len(callback.seen) + subscriber.dropped, 9)
+        self.assertTrue(subscriber.max_latency >= 0.05)
+
+    def test_remove(self):
+        # A subscriber that is already running stops after its message
+        callback = RecordingCallback(delay=0.05)
+        for code in range(4):
+            self.dispatcher.submit(callback, ChannelEventMessage(
+                message_code=code))
+        while not callback.seen:
+            time.sleep(0.001)
+        self.dispatcher.remove(callback)
+        time.sleep(0.2)
+        self.assertTrue(len(callback.seen) <= 2)
+        self.assertEquals(self.dispatcher.subscribers, {})
+
+
+class PipeDriver(Driver):
+    def __init__(self):
+        Driver.__init__(self, 'pipe')
+        self.rfd, self.wfd = os.pipe()
+
+    def _open(self):
+        pass
+
+    def _close(self):
+        pass
+
+    def _fileno(self):
+        return self.rfd
+
+    def _wait(self, timeout):
+        return bool(select.select([self.rfd], [], [], timeout)[0])
+
+    def _read(self, count):
+        return os.read(self.rfd, count)
+
+    def _write(self, data):
+        return len(data)
+
+
+class EventLoopTest(unittest.TestCase):
+    def test_loop(self):
+        loop = EventLoop()
+        self.assertRaises(DriverError, loop.add, EventMachine(QueueDriver()))
+
+        machines = []
+        for i in range(4):
+            driver = PipeDriver()
+            driver.open()
+            evm = EventMachine(driver)
+            evm.start()
+            loop.add(evm)
+            machines.append(evm)
+        self.assertFalse(machines[0].running)
+
+        futures = [evm.sendCommand(ChannelOpenMessage(number=i))
+                   for i, evm in enumerate(machines)]
+        for i, evm in enumerate(machines):
+            os.write(evm.driver.wfd, ChannelEventMessage(
+                number=i, message_id=MESSAGE_CHANNEL_OPEN).encode())
+
+        thread.start_new_thread(loop.run, ())
+        try:
+            for i, future in enumerate(futures):
+                self.assertEquals(future.wait(1).getChannelNumber(), i)
+        finally:
+            loop.stop()
+
+    def test_driver_error(self):
+        # A machine whose driver fails is dropped; the others still run
+        class BrokenDriver(PipeDriver):
+            def _read(self, count):
+                raise DriverError('Device unplugged.')
+
+        loop = EventLoop()
+        broken = EventMachine(BrokenDriver())
+        working = EventMachine(PipeDriver())
+        for evm in (broken, working):
+            evm.driver.open()
+            evm.start()
+            loop.add(evm)
+            os.write(evm.driver.wfd, ChannelEventMessage(
+                number=1, message_id=MESSAGE_CHANNEL_OPEN).encode())
+
+        future = working.sendCommand(ChannelOpenMessage(number=1))
+        loop.runOnce(1)
+        self.assertTrue(isinstance(broken.pump_error, DriverError))
+        self.assertEquals(loop.machines.values(), [working])
+        self.assertEquals(future.wait(1).getChannelNumber(), 1)
+
+
+class EventMachineTest(unittest.TestCase):
+    def setUp(self):
+        self.driver = QueueDriver()
+        self.driver.open()
+        self.evm = EventMachine(self.driver)
+        self.evm.start()
+
+    def tearDown(self):
+        self.evm.stop()
+        self.driver.close()
+
+    def test_pump(self):
+        raw = ''.join(ChannelEventMessage(number=i).encode()
+                      for i in range(8))
+        self.driver.queue.put(raw)
+        for i in range(8):
+            msg = self.evm.waitForMessage(ChannelEventMessage)
+            self.assertEquals(msg.getChannelNumber(), i)
+
+    def test_block(self):
+        # A full queue holds the pump until a reader takes from it
+        self.evm.stop()
+        self.evm = EventMachine(self.driver, msg_queue=RingQueue(
+            1, OVERFLOW_BLOCK, block_timeout=1))
+        self.evm.start()
+        self.driver.queue.put(''.join(ChannelStatusMessage(number=i).encode()
+                                      for i in range(3)))
+        time.sleep(0.05)
+        for i in range(3):
+            msg = self.evm.waitForMessage(ChannelStatusMessage, 1)
+            self.assertEquals(msg.getChannelNumber(), i)
+        self.assertEquals(self.evm.msg.dropped, 0)
+
+        self.assertRaises(ValueError, EventMachine, QueueDriver(),
+                          msg_queue=RingQueue(1, OVERFLOW_BLOCK, None))
+
+    def test_pump_without_memoryview(self):
+        # As on Python 2.6, where the pump reads and feeds strings
+        driver = QueueDriver()
+        driver.open()
+        evm = EventMachine(driver)
+        driver.queue.put(ChannelEventMessage(number=3).encode())
+        has_memoryview, event.HAS_MEMORYVIEW = event.HAS_MEMORYVIEW, False
+        try:
+            messages = evm.pumpOnce(1)
+        finally:
+            event.HAS_MEMORYVIEW = has_memoryview
+            driver.close()
+        self.assertEquals([msg.getChannelNumber() for msg in messages], [3])
+
+    def test_waitForAck(self):
+        msg = ChannelOpenMessage(number=2)
+        self.driver.queue.put(ChannelEventMessage(
+            number=2, message_id=MESSAGE_CHANNEL_OPEN,
+            message_code=RESPONSE_NO_ERROR).encode())
+        self.assertEquals(self.evm.waitForAck(msg), RESPONSE_NO_ERROR)
+
+    def test_wait_timeout(self):
+        start = time.time()
+        self.assertRaises(TimeoutError, self.evm.waitForAck,
+                          ChannelOpenMessage(), 0.05)
+        self.assertRaises(TimeoutError, self.evm.waitForMessage,
+                          CapabilitiesMessage, 0.05)
+        self.assertTrue(time.time() - start < 1)
+
+    def test_wait_wakeup(self):
+        # Waiters are woken by the dispatch itself, not a polling loop
+        def post():
+            time.sleep(0.2)
+            posted.append(time.time())
+            self.driver.queue.put(CapabilitiesMessage().encode())
+
+        posted = []
+        thread.start_new_thread(post, ())
+        self.evm.waitForMessage(CapabilitiesMessage, 5)
+        self.assertTrue(time.time() - posted[0] < 0.02)
+
+    def test_sendCommand(self):
+        # Responses are matched on channel number, whatever their order
+        first = self.evm.sendCommand(ChannelOpenMessage(number=1))
+        second = self.evm.sendCommand(ChannelOpenMessage(number=2))
+        self.driver.queue.put(ChannelEventMessage(
+            number=2, message_id=MESSAGE_CHANNEL_OPEN,
+            message_code=CHANNEL_IN_WRONG_STATE).encode())
+        self.assertEquals(second.wait(1).getMessageCode(),
+                          CHANNEL_IN_WRONG_STATE)
+        self.assertFalse(first.isDone())
+        self.driver.queue.put(ChannelEventMessage(
+            number=1, message_id=MESSAGE_CHANNEL_OPEN).encode())
+        self.assertEquals(first.wait(1).getChannelNumber(), 1)
+        self.assertEquals(self.evm.pending, {})
+
+    def test_sendCommand_timeout(self):
+        future = self.evm.sendCommand(ChannelOpenMessage(number=1))
+        self.assertRaises(TimeoutError, future.wait, 0.01)
+        self.assertEquals(self.evm.pending, {})
+
+    def test_requestMessage(self):
+        future = self.evm.requestMessage(MESSAGE_CHANNEL_STATUS, 3)
+        self.driver.queue.put(ChannelStatusMessage(number=1).encode())
+        self.driver.queue.put(ChannelStatusMessage(number=3,
+                                                   status=0x02).encode())
+        self.assertEquals(future.wait(1).getStatus(), 0x02)
+        self.assertEquals(self.evm.waitForMessage(ChannelStatusMessage, 1)
+                          .getChannelNumber(), 1)
+
+    def test_expectEvent(self):
+        future = self.evm.expectEvent(4, EVENT_CHANNEL_CLOSED)
+        self.driver.queue.put(ChannelEventMessage(
+            number=4, message_id=MESSAGE_RF_EVENT,
+            message_code=EVENT_RX_FAIL).encode())
+        self.driver.queue.put(ChannelEventMessage(
+            number=5, message_id=MESSAGE_RF_EVENT,
+            message_code=EVENT_CHANNEL_CLOSED).encode())
+        self.driver.queue.put(ChannelEventMessage(
+            number=4, message_id=MESSAGE_RF_EVENT,
+            message_code=EVENT_CHANNEL_CLOSED).encode())
+        self.assertEquals(future.wait(1).getChannelNumber(), 4)
+
+    def test_subscribe(self):
+        everything = RecordingCallback()
+        events = RecordingCallback()
+        channel = RecordingCallback()
+        self.evm.subscribe(everything)
+        self.evm.subscribe(events, ChannelEventMessage)
+        self.evm.subscribe(channel, ChannelMessage, 2)
+        self.evm.dispatch([ChannelEventMessage(number=1, message_code=1),
+                           ChannelEventMessage(number=2, message_code=2),
+                           ChannelBroadcastDataMessage(number=2),
+                           CapabilitiesMessage()])
+        self.assertEquals(len(everything.seen), 4)
+        self.assertEquals(events.seen, [1, 2])
+        self.assertEquals(len(channel.seen), 2)
+
+        # Unsubscribing swaps in a new index instead of editing the old one
+        subscriptions, routes = self.evm.index
+        self.evm.unsubscribe(everything)
+        self.assertEquals(len(routes), 4)
+        self.assertEquals(self.evm.index[1], {})
+        self.evm.dispatch([CapabilitiesMessage()])
+        self.assertEquals(len(everything.seen), 4)
+
+    def test_dispatcher(self):
+        # A slow callback on the dispatcher does not hold up acks
+        self.evm.setDispatcher(Dispatcher(workers=1))
+        slow = RecordingCallback(delay=0.5)
+        self.evm.registerCallback(slow)
+        self.driver.queue.put(ChannelEventMessage(
+            number=1, message_id=MESSAGE_RF_EVENT,
+            message_code=0xFF).encode())
+        future = self.evm.sendCommand(ChannelOpenMessage(number=1))
+        self.driver.queue.put(ChannelEventMessage(
+            number=1, message_id=MESSAGE_CHANNEL_OPEN).encode())
+        future.wait(0.2)
+        self.assertTrue(slow.done.wait(2) or slow.done.isSet())
+        self.evm.removeCallback(slow)
+        self.assertEquals(self.evm.dispatcher.subscribers, {})
+        self.evm.dispatcher.stop()
+
+    def test_idle(self):
+        # An idle pump blocks in the driver instead of spinning
+        waits = self.driver.waits
+        time.sleep(PUMP_TIMEOUT * 3)
+        self.assertTrue(self.driver.waits - waits <= 4)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2011, Martín Raúl Villalba
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+##############################################################################
+
+import Queue
+import threading
+import time
+
+from ant.core.driver import Driver
+from ant.core.event import Framer
+
+
+class QueueDriver(Driver):
+    """A stand-in stick: reads come out of queue, and every message
+    written is passed to reply(), whose answers are queued to be read.
+
+    With latency, a worker thread sends the answers to each write that
+    many seconds after it, like a USB round trip.
+
+    """
+    def __init__(self, latency=0):
+        Driver.__init__(self, 'queue')
+        self.queue = Queue.Queue()
+        self.data = ''
+        self.waits = 0
+        self.framer = Framer()
+        self.written = []
+        self.writes = 0
+        self.latency = latency
+        if latency:
+            self.incoming = Queue.Queue()
+            worker = threading.Thread(target=self._delay)
+            worker.setDaemon(True)
+            worker.start()
+
+    def _open(self):
+        pass
+
+    def _close(self):
+        pass
+
+    def _wait(self, timeout):
+        self.waits += 1
+        if not self.data:
+            try:
+                self.data = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                return False
+        return True
+
+    def _available(self):
+        return len(self.data)
+
+    def _read(self, count):
+        data, self.data = self.data[:count], self.data[count:]
+        return data
+
+    def _write(self, data):
+        self.writes += 1
+        messages = self.framer.feed(data)
+        self.written.extend(messages)
+        if self.latency:
+            self.incoming.put(messages)
+        else:
+            self._answer(messages)
+        return len(data)
+
+    def _delay(self):
+        while True:
+            messages = self.incoming.get()
+            time.sleep(self.latency)
+            self._answer(messages)
+
+    def _answer(self, messages):
+        for msg in messages:
+            for reply in self.reply(msg):
+                self.queue.put(reply.encode())
+
+    def reply(self, msg):
+        return []
@@ -25,8 +25,13 @@
 
 LOG_LOCATION = '/tmp/python-ant.logtest.ant'
 
+import os
 import unittest
 
+import msgpack
+
+from ant.core import log
+from ant.core import message
 from ant.core.log import *
 
 
@@ -79,6 +84,163 @@ class LogReaderTest(unittest.TestCase):
         self.assertTrue(isinstance(t1[1], int))
         self.assertEquals(len(t5), 2)
 
+    def test_iter(self):
+        events = [ev[0] for ev in self.log]
+        self.assertEquals(events, [EVENT_OPEN, EVENT_READ, EVENT_WRITE,
+                                   EVENT_READ, EVENT_CLOSE])
+        self.assertEquals(self.log.read(), None)
+
+    def test_chunked(self):
+        lw = LogWriter(LOG_LOCATION)
+        for i in range(1000):
+            lw.logRead(chr(i % 256) * (i % 50 + 1))
+        lw.close()
+
+        read_size = log.READ_SIZE
+        log.READ_SIZE = 7
+        try:
+            self.log.open(LOG_LOCATION)
+            # A reader nobody else holds stays open while iterated over
+            count = 0
+            for ev in LogReader(LOG_LOCATION):
+                count += 1
+            self.assertEquals(count, 1000)
+        finally:
+            log.READ_SIZE = read_size
+        for i, ev in enumerate(self.log):
+            self.assertEquals(ev[2], chr(i % 256) * (i % 50 + 1))
+        self.assertEquals(i, 999)
+
+    def test_unknown_format(self):
+        open(LOG_LOCATION, 'wb').write('not a log')
+        self.assertRaises(IOError, LogReader, LOG_LOCATION)
+
+
+def broadcast(number):
+    return message.ChannelBroadcastDataMessage(number=number).encode()
+
+
+class LogIndexTest(unittest.TestCase):
+    def setUp(self):
+        # One event per second for 100 s; channel 3 only shows up from 75 s
+        self.events = [[EVENT_READ, t, broadcast(t // 25)]
+                       for t in range(100)]
+        self.write(self.events)
+        BuildIndex(LOG_LOCATION, block=10)
+        self.log = LogReader(LOG_LOCATION)
+
+    def tearDown(self):
+        self.log.close()
+        if os.path.exists(LOG_LOCATION + INDEX_SUFFIX):
+            os.remove(LOG_LOCATION + INDEX_SUFFIX)
+
+    def write(self, events, mode='wb'):
+        packer = msgpack.Packer()
+        fd = open(LOG_LOCATION, mode)
+        if mode == 'wb':
+            fd.write(packer.pack(['ANT-LOG', 0x01]))
+        for ev in events:
+            fd.write(packer.pack(ev))
+        fd.close()
+
+    def test_index(self):
+        self.assertEquals(len(self.log.index), 10)
+        self.assertEquals(self.log.index[0][INDEX_OFFSET], self.log.start)
+        for prev, entry in zip(self.log.index, self.log.index[1:]):
+            self.assertEquals(prev[INDEX_END], entry[INDEX_OFFSET])
+        self.assertEquals(self.log.index[-1][INDEX_END],
+                          os.path.getsize(LOG_LOCATION))
+        self.assertEquals(self.log.index[7][INDEX_FIRST:INDEX_CHANNELS],
+                          [70, 79])
+        self.assertEquals(self.log.index[7][INDEX_CHANNELS], '\x0C')
+
+    def test_query(self):
+        self.assertEquals(list(self.log.query(40, 49)), self.events[40:50])
+        self.assertEquals(list(self.log.query()), self.events)
+
+        self.assertEquals(list(self.log.query(channels=[3])),
+                          self.events[70:])
+        self.assertEquals(list(self.log.query(end=80, channels=[3])),
+                          self.events[70:81])
+        self.assertEquals(list(self.log.query(types=[MESSAGE_CHANNEL_OPEN])),
+                          [])
+        self.assertEquals(
+            len(list(self.log.query(types=[MESSAGE_CHANNEL_BROADCAST_DATA]))),
+            100)
+
+        # The reader stays where it was
+        self.assertEquals(self.log.read(), self.events[0])
+
+    def test_regions(self):
+        self.assertEquals(len(self.log._regions(40, 49, None, None)), 2)
+        self.assertEquals(self.log._regions(40, 49, None, None)[0],
+                          [self.log.index[4][INDEX_OFFSET],
+                           self.log.index[4][INDEX_END]])
+
+    def test_appended(self):
+        # The index no longer matches, so the whole log is scanned
+        more = [[EVENT_READ, t, broadcast(5)] for t in range(100, 110)]
+        self.write(more, 'ab')
+        self.log.open(LOG_LOCATION)
+        self.assertEquals(self.log.index, None)
+        self.assertEquals(list(self.log.query(105)), more[5:])
+        self.log.seek(100)
+        self.assertEquals(self.log.read(), more[0])
+
+    def test_rewritten(self):
+        events = [[EVENT_READ, t, broadcast(5)] for t in range(200, 300)]
+        self.write(events)
+        self.log.open(LOG_LOCATION)
+        self.assertEquals(self.log.index, None)
+        self.assertEquals(list(self.log.query(240, 249)), events[40:50])
+        self.log.seek(257)
+        self.assertEquals(self.log.read(), events[57])
+
+        # Rewriting it without an index drops the old one
+        BuildIndex(LOG_LOCATION)
+        lw = LogWriter(LOG_LOCATION)
+        self.assertFalse(os.path.exists(LOG_LOCATION + INDEX_SUFFIX))
+        lw.logOpen()
+        lw.close()
+        self.assertEquals(LogReader(LOG_LOCATION).index, None)
+
+    def test_seek(self):
+        self.log.seek(57)
+        self.assertEquals(self.log.read(), self.events[57])
+        self.log.seek(0)
+        self.assertEquals(list(self.log), self.events)
+        self.log.seek(1000)
+        self.assertEquals(self.log.read(), None)
+
+        os.remove(LOG_LOCATION + INDEX_SUFFIX)
+        self.log.open(LOG_LOCATION)
+        self.assertEquals(self.log.index, None)
+        self.log.seek(57)
+        self.assertEquals(self.log.read(), self.events[57])
+
+    def test_writer(self):
+        # Frames split across reads stay within one block
+        lw = LogWriter(LOG_LOCATION, index=True)
+        lw.logOpen()
+        for i in range(3000):
+            raw = broadcast(i % 8)
+            lw.logRead(raw[:5])
+            lw.logRead(raw[5:])
+            lw.logWrite(message.ChannelOpenMessage(number=i % 8).encode())
+        lw.close()
+
+        written = LogReader(LOG_LOCATION).index
+        self.assertEquals(len(written), 9003 // INDEX_BLOCK + 1)
+        for entry in written:
+            self.assertEquals(entry[INDEX_CHANNELS], '\xFF')
+            self.assertTrue(log._isSet(entry[INDEX_TYPES],
+                                   [MESSAGE_CHANNEL_BROADCAST_DATA]))
+            self.assertTrue(log._isSet(entry[INDEX_TYPES],
+                                   [MESSAGE_CHANNEL_OPEN]))
+
+        BuildIndex(LOG_LOCATION)
+        self.assertEquals(LogReader(LOG_LOCATION).index, written)
+
 
 class LogWriterTest(unittest.TestCase):
     def setUp(self):
@@ -25,6 +25,7 @@
 
 import unittest
 
+from ant.core.event import HAS_MEMORYVIEW
 from ant.core.message import *
 
 
@@ -50,6 +51,8 @@ class MessageTest(unittest.TestCase):
         self.message = Message(type_=MESSAGE_CHANNEL_ASSIGN,
                                payload='\x00' * 3)
         self.assertEquals(self.message.getChecksum(), 0xE5)
+        self.message = Message(type_=0x5A, payload='\x00')
+        self.assertEquals(self.message.getChecksum(), 0xFF)
 
     def test_getSize(self):
         self.message.setPayload('\x11' * 7)
@@ -61,6 +64,35 @@ class MessageTest(unittest.TestCase):
         self.assertEqual(self.message.encode(),
                          '\xA4\x03\x42\x00\x00\x00\xE5')
 
+    def test_encode_cache(self):
+        self.message = ChannelIDMessage(number=0x01, device_number=0x1234)
+        raw = self.message.encode()
+        self.assertTrue(self.message.encode() is raw)
+
+        # Field setters patch the cached frame and checksum in place
+        self.message.setDeviceNumber(0xABCD)
+        self.message.setTransmissionType(0xFF)
+        expected = ChannelIDMessage(number=0x01, device_number=0xABCD,
+                                    trans_type=0xFF)
+        self.assertEquals(self.message.encode(), expected.encode())
+        self.assertEquals(self.message.getChecksum(),
+                          ord(expected.encode()[-1]))
+
+        # Changing the type or payload drops the cache
+        self.message.setType(MESSAGE_CHANNEL_PERIOD)
+        self.assertEquals(self.message.encode()[2],
+                          chr(MESSAGE_CHANNEL_PERIOD))
+        self.message.setPayload('\x01')
+        self.assertEquals(self.message.encode(), '\xA4\x01\x43\x01\xE7')
+
+    def test_encodeBatch(self):
+        messages = [Message(type_=MESSAGE_SYSTEM_RESET, payload='\x00'),
+                    Message(type_=MESSAGE_CHANNEL_ASSIGN, payload='\x00' * 3)]
+        data, offsets = Message.encodeBatch(messages)
+        self.assertEquals(data, messages[0].encode() + messages[1].encode())
+        self.assertEquals(offsets, [0, 5])
+        self.assertEquals(Message.encodeBatch([]), ('', []))
+
     def test_decode(self):
         self.assertRaises(MessageError, self.message.decode,
                           '\xA5\x03\x42\x00\x00\x00\xE5')
@@ -74,6 +106,17 @@ class MessageTest(unittest.TestCase):
         self.assertEqual(self.message.getPayload(), '\x00' * 3)
         self.assertEqual(self.message.getChecksum(), 0xE5)
 
+    def test_decode_offset(self):
+        raw = '\x00\x00\xA4\x03\x42\x01\x02\x03\xE5\xFF'
+        self.assertRaises(MessageError, self.message.decode, raw)
+        self.assertEqual(self.message.decode(raw, 2), 7)
+        self.assertEqual(self.message.getPayload(), '\x01\x02\x03')
+        if HAS_MEMORYVIEW:
+            self.assertEqual(self.message.decode(memoryview(raw), 2), 7)
+            self.assertEqual(self.message.getPayload(), '\x01\x02\x03')
+        self.assertEqual(self.message.decode(bytearray(raw), 2), 7)
+        self.assertTrue(isinstance(self.message.payload, bytearray))
+
     def test_getHandler(self):
         handler = self.message.getHandler('\xA4\x03\x42\x00\x00\x00\xE5')
         self.assertTrue(isinstance(handler, ChannelAssignMessage))
@@ -84,6 +127,58 @@ class MessageTest(unittest.TestCase):
         self.assertRaises(MessageError, self.message.getHandler,
                           '\xA4\x05\x42\x00\x00\x00\x00')
 
+        # Unknown types come back as plain messages
+        handler = self.message.getHandler('\xA4\x01\x71\x20\xF4')
+        self.assertEquals(type(handler), Message)
+        self.assertEquals(handler.getType(), MESSAGE_PROXIMITY_SEARCH)
+        self.assertEquals(handler.getPayload(), '\x20')
+
+    def test_fromPayload(self):
+        msg = ChannelIDMessage.fromPayload(MESSAGE_CHANNEL_ID,
+                                           '\x01\x02\x03\x04\x05')
+        self.assertTrue(isinstance(msg, ChannelIDMessage))
+        self.assertEquals(msg.getType(), MESSAGE_CHANNEL_ID)
+        self.assertEquals(msg.getChannelNumber(), 0x01)
+        self.assertEquals(msg.getDeviceNumber(), 0x0302)
+        self.assertEquals(msg.getTransmissionType(), 0x05)
+
+    def test_fields(self):
+        class TestMessage(Message):
+            fields = (('Counter', 0, 'H'),
+                      ('Tag', 2, '2s'),)
+
+            def __init__(self):
+                Message.__init__(self, type_=0x01, payload='\x00' * 4)
+
+        self.message = TestMessage()
+        self.message.setCounter(0xABCD)
+        self.message.setTag('ZZ')
+        self.assertEquals(self.message.getCounter(), 0xABCD)
+        self.assertEquals(self.message.getTag(), 'ZZ')
+        self.assertEquals(self.message.getPayload(), '\xCD\xABZZ')
+        self.assertRaises(MessageError, self.message.setCounter, 0x10000)
+        self.assertRaises(MessageError, self.message.setCounter, -1)
+        self.assertRaises(MessageError, self.message.setTag, 'ZZZ')
+
+    def test_registerHandler(self):
+        class ProximitySearchMessage(Message):
+            def __init__(self):
+                Message.__init__(self, type_=MESSAGE_PROXIMITY_SEARCH,
+                                 payload='\x00')
+
+        self.assertRaises(MessageError, Message.registerHandler, 0x100,
+                          ProximitySearchMessage)
+        Message.registerHandler(MESSAGE_PROXIMITY_SEARCH,
+                                ProximitySearchMessage)
+        try:
+            handler = self.message.getHandler('\xA4\x01\x71\x20\xF4')
+            self.assertTrue(isinstance(handler, ProximitySearchMessage))
+            self.assertEquals(handler.getPayload(), '\x20')
+        finally:
+            Message.removeHandler(MESSAGE_PROXIMITY_SEARCH)
+        handler = self.message.getHandler('\xA4\x01\x71\x20\xF4')
+        self.assertEquals(type(handler), Message)
+
 
 class ChannelMessageTest(unittest.TestCase):
     def setUp(self):
@@ -126,6 +221,7 @@ class ChannelIDMessageTest(unittest.TestCase):
     def test_get_setDeviceNumber(self):
         self.message.setDeviceNumber(0x10FA)
         self.assertEquals(self.message.getDeviceNumber(), 0x10FA)
+        self.assertRaises(MessageError, self.message.setDeviceNumber, 0x10000)
 
     def test_get_setDeviceType(self):
         self.message.setDeviceType(0x10)
@@ -231,6 +327,21 @@ class TXPowerMessageTest(unittest.TestCase):
         self.assertEquals(self.message.getPayload(), '\x00\x01')
 
 
+class StartupMessageTest(unittest.TestCase):
+    def setUp(self):
+        self.message = StartupMessage()
+
+    def test_get_setReason(self):
+        self.message.setReason(STARTUP_COMMAND_RESET)
+        self.assertEquals(self.message.getReason(), STARTUP_COMMAND_RESET)
+
+    def test_handler(self):
+        raw = StartupMessage(STARTUP_WATCHDOG_RESET).encode()
+        msg = Message().getHandler(raw)
+        self.assertTrue(isinstance(msg, StartupMessage))
+        self.assertEquals(msg.getReason(), STARTUP_WATCHDOG_RESET)
+
+
 class SystemResetMessageTest(unittest.TestCase):
     # No currently defined methods need testing
     pass
@@ -262,8 +373,28 @@ class ChannelRequestMessageTest(unittest.TestCase):
 
 
 class ChannelBroadcastDataMessageTest(unittest.TestCase):
-    # No currently defined methods need testing
-    pass
+    def setUp(self):
+        self.message = ChannelBroadcastDataMessage(number=0x01,
+                                                   data='\x00' * 8)
+        self.message.encode()
+
+    def test_get_setData(self):
+        self.message.setData('\x01' * 8)
+        self.assertEquals(self.message.getData(), '\x01' * 8)
+        expected = ChannelBroadcastDataMessage(number=0x01, data='\x01' * 8)
+        self.assertEquals(self.message.encode(), expected.encode())
+
+        self.message.setData('\x02')
+        self.assertEquals(self.message.getChannelNumber(), 0x01)
+        self.assertEquals(self.message.encode(), '\xA4\x02\x4E\x01\x02\xEB')
+
+    def test_payload_in_place(self):
+        self.message.payload[8] = 0x2A
+        expected = ChannelBroadcastDataMessage(number=0x01,
+                                               data='\x00' * 7 + '\x2A')
+        self.assertEquals(self.message.encode(), expected.encode())
+        self.assertEquals(self.message.getChecksum(),
+                          ord(expected.encode()[-1]))
 
 
 class ChannelAcknowledgedDataMessageTest(unittest.TestCase):
@@ -306,6 +437,15 @@ class ChannelStatusMessageTest(unittest.TestCase):
         self.assertEquals(self.message.getStatus(), 0xFA)
         self.assertRaises(MessageError, self.message.setStatus, 0xFFFF)
 
+    def test_status_fields(self):
+        self.message.setStatus(CHANNEL_TYPE_ONEWAY_RECEIVE | 0x02 << 2 |
+                               CHANNEL_STATE_SEARCHING)
+        self.assertEquals(self.message.getChannelState(),
+                          CHANNEL_STATE_SEARCHING)
+        self.assertEquals(self.message.getNetworkNumber(), 0x02)
+        self.assertEquals(self.message.getChannelType(),
+                          CHANNEL_TYPE_ONEWAY_RECEIVE)
+
     def test_payload(self):
         self.message.setChannelNumber(0x01)
         self.message.setStatus(0x02)
@@ -365,6 +505,16 @@ class CapabilitiesMessageTest(unittest.TestCase):
         self.message.setAdvOptions2(0x05)
         self.assertEquals(self.message.getPayload(), '\x01\x02\x03\x04\x05')
 
+    def test_encode_cache(self):
+        self.message = CapabilitiesMessage(adv_opts2=None)
+        self.message.encode()
+        self.message.setAdvOptions2(0x05)
+        self.assertEquals(self.message.encode(),
+                          CapabilitiesMessage(adv_opts2=0x05).encode())
+        self.message.setAdvOptions2(0x06)
+        self.assertEquals(self.message.encode(),
+                          CapabilitiesMessage(adv_opts2=0x06).encode())
+
 
 class SerialNumberMessageTest(unittest.TestCase):
     def setUp(self):
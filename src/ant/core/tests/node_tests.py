@@ -23,8 +23,194 @@
 #
 ##############################################################################
 
+import Queue
+import thread
+import time
 import unittest
 
 from ant.core.node import *
 
-#TODO
+from fakes import QueueDriver
+
+
+class FakeStick(QueueDriver):
+    """Answers commands the way an ANT stick with 8 channels would."""
+    def __init__(self):
+        QueueDriver.__init__(self)
+        self.failures = set()
+        self.drops = set()  # (number, msg type): swallow the next response
+        self.startup = True
+        self.configured = {}  # number: (status, (device type, number, tx))
+
+    def reply(self, msg):
+        if isinstance(msg, message.SystemResetMessage):
+            if not self.startup:
+                return []  # Firmware too old to announce itself
+            return [message.StartupMessage(STARTUP_COMMAND_RESET)]
+        if isinstance(msg, message.ChannelRequestMessage):
+            number = msg.getChannelNumber()
+            status, device = self.configured.get(number, (0x00, None))
+            if msg.getMessageID() == MESSAGE_CAPABILITIES:
+                return [message.CapabilitiesMessage(8, 3)]
+            if msg.getMessageID() == MESSAGE_CHANNEL_STATUS:
+                return [message.ChannelStatusMessage(number, status)]
+            if msg.getMessageID() == MESSAGE_CHANNEL_ID and device:
+                return [message.ChannelIDMessage(number, device[1],
+                                                 device[0], device[2])]
+            return []
+
+        if (msg.payload[0], msg.getType()) in self.drops:
+            self.drops.remove((msg.payload[0], msg.getType()))
+            return []
+        ack = message.ChannelEventMessage(number=msg.payload[0],
+                                          message_id=msg.getType())
+        if (msg.payload[0], msg.getType()) in self.failures:
+            ack.setMessageCode(CHANNEL_IN_WRONG_STATE)
+        if isinstance(msg, message.ChannelCloseMessage):
+            closed = message.ChannelEventMessage(
+                number=msg.getChannelNumber(), message_id=MESSAGE_RF_EVENT,
+                message_code=EVENT_CHANNEL_CLOSED)
+            return [ack, closed]
+        return [ack]
+
+
+class NodeTest(unittest.TestCase):
+    def setUp(self):
+        self.stick = FakeStick()
+        self.node = Node(self.stick)
+        self.node.start()
+
+    def tearDown(self):
+        if self.node.running:
+            self.node.stop()
+
+    def test_init(self):
+        self.assertEquals(len(self.node.channels), 8)
+        self.assertEquals(len(self.node.networks), 3)
+
+    def test_concurrent_channels(self):
+        def configure(channel, errors, done):
+            try:
+                channel.assign(self.node.networks[0].name,
+                               CHANNEL_TYPE_TWOWAY_RECEIVE)
+                channel.setID(120, 0, 0)
+                channel.setPeriod(8070)
+                channel.open()
+                channel.close()
+            except Exception, e:
+                errors.append(e)
+            done.put(channel.number)
+
+        errors = []
+        done = Queue.Queue()
+        for channel in self.node.channels:
+            thread.start_new_thread(configure, (channel, errors, done))
+        for channel in self.node.channels:
+            done.get(timeout=5)
+
+        self.assertEquals(errors, [])
+        self.assertEquals(self.node.evm.pending, {})
+
+    def test_reset(self):
+        start = time.time()
+        msg = self.node.evm.reset()
+        self.assertEquals(msg.getReason(), STARTUP_COMMAND_RESET)
+        self.assertTrue(time.time() - start < 0.5)
+
+        self.stick.startup = False
+        start = time.time()
+        self.assertEquals(self.node.evm.reset(0.1), None)
+        self.assertTrue(time.time() - start >= 0.1)
+        self.assertEquals(self.node.evm.pending, {})
+
+    def test_attach(self):
+        # A warm start picks up the channels left running on the stick
+        stick = FakeStick()
+        status = CHANNEL_TYPE_TWOWAY_TRANSMIT | 1 << 2 | \
+                 CHANNEL_STATE_TRACKING
+        stick.configured[1] = (status, (120, 1234, 1))
+        node = Node(stick)
+        node.start(warm=True)
+        try:
+            self.assertEquals(len(node.channels), 8)
+            channel = node.channels[1]
+            self.assertFalse(channel.is_free)
+            self.assertEquals(channel.state, CHANNEL_STATE_TRACKING)
+            self.assertTrue(channel.network is node.networks[1])
+            self.assertEquals(channel.type, CHANNEL_TYPE_TWOWAY_TRANSMIT)
+            self.assertEquals(channel.device, (120, 1234, 1))
+            self.assertTrue(node.getFreeChannel() is node.channels[0])
+            for msg in stick.written:
+                self.assertTrue(isinstance(msg, message.ChannelRequestMessage))
+        finally:
+            node.stop(reset=False)
+
+    def test_configureChannels(self):
+        writes = self.stick.writes
+        written = len(self.stick.written)
+        config = dict(net_key=self.node.networks[0].name,
+                      ch_type=CHANNEL_TYPE_TWOWAY_RECEIVE,
+                      device=(120, 0, 0), period=8070, frequency=57)
+        channels = self.node.configureChannels([config] * 8)
+        self.assertEquals([c.number for c in channels], range(8))
+        self.assertFalse(True in [c.is_free for c in channels])
+        self.assertEquals(self.stick.writes - writes, 1)
+        self.assertEquals(len(self.stick.written) - written, 8 * 5)
+        self.assertEquals(self.node.evm.pending, {})
+
+    def test_configureChannels_reserved(self):
+        config = dict(net_key=self.node.networks[0].name,
+                      ch_type=CHANNEL_TYPE_TWOWAY_RECEIVE)
+
+        # Concurrent calls never pick the same channel
+        results = Queue.Queue()
+        for i in range(2):
+            thread.start_new_thread(
+                lambda: results.put(self.node.configureChannels([config] * 4)),
+                ())
+        numbers = [c.number for i in range(2)
+                   for c in results.get(timeout=5)]
+        self.assertEquals(sorted(numbers), range(8))
+
+        # A channel that couldn't be assigned is free again
+        self.node.channels[5].unassign()
+        self.stick.failures.add((5, MESSAGE_CHANNEL_ASSIGN))
+        self.assertRaises(ConfigurationError, self.node.configureChannels,
+                          [config])
+        self.assertTrue(self.node.channels[5].is_free)
+
+    def test_configure_errors(self):
+        self.stick.failures.add((2, MESSAGE_CHANNEL_ID))
+        self.stick.failures.add((2, MESSAGE_CHANNEL_OPEN))
+        channel = self.node.channels[2]
+        try:
+            channel.configure(self.node.networks[0].name,
+                              CHANNEL_TYPE_TWOWAY_RECEIVE,
+                              device=(120, 0, 0), period=8070)
+        except ConfigurationError, e:
+            self.assertEquals([(n, t) for n, t, error in e.errors],
+                              [(2, MESSAGE_CHANNEL_ID),
+                               (2, MESSAGE_CHANNEL_OPEN)])
+            self.assertTrue(isinstance(e.errors[0][2], ChannelError))
+        else:
+            self.fail('ConfigurationError not raised')
+        self.assertFalse(channel.is_free)
+
+    def test_nonblocking(self):
+        channel = self.node.getFreeChannel()
+        future = channel.assign(self.node.networks[0].name,
+                                CHANNEL_TYPE_TWOWAY_RECEIVE, block=False)
+        future.then(lambda r: channel.open(block=False)).wait(1)
+        self.assertFalse(channel.is_free)
+        self.assertTrue(isinstance(self.stick.written[-1],
+                                   message.ChannelOpenMessage))
+
+        stream = channel.messages(maxsize=4)
+        self.stick.queue.put(message.ChannelBroadcastDataMessage(
+            number=channel.number, data='\x01' * 7).encode())
+        msg = stream.get(1)
+        while not isinstance(msg, message.ChannelBroadcastDataMessage):
+            msg = stream.get(1)  # Skip the open ack, if it raced us
+        self.assertEquals(msg.payload[-1], 0x01)
+
+        channel.close(block=False).wait(1)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2011, Martín Raúl Villalba
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+##############################################################################
+
+import os
+import select
+import signal
+import threading
+import time
+import tty
+import unittest
+
+from ant.core import process
+from ant.core.driver import USB1Driver
+from ant.core.event import EventMachine
+from ant.core.exceptions import DriverError
+from ant.core.message import *
+from ant.core.process import *
+
+
+class FrameRingTest(unittest.TestCase):
+    def test_wrap(self):
+        ring = FrameRing(16)
+        buffer_ = bytearray(16)
+        for i in range(5):
+            self.assertTrue(ring.put(chr(i) * 7))
+            self.assertEquals(ring.pending(), 7)
+            self.assertEquals(ring.readinto(buffer_), 7)
+            self.assertEquals(str(buffer_[0:7]), chr(i) * 7)
+
+    def test_full(self):
+        ring = FrameRing(16)
+        self.assertTrue(ring.put('\x01' * 10))
+        self.assertFalse(ring.put('\x02' * 10))
+        self.assertTrue(ring.put('\x03' * 6))
+        self.assertEquals(ring.dropped(), 1)
+        buffer_ = bytearray(4)
+        self.assertEquals(ring.readinto(buffer_), 4)
+        self.assertEquals(ring.pending(), 12)
+
+
+if hasattr(os, 'openpty'):
+    class ProcessDriverTest(unittest.TestCase):
+        def setUp(self):
+            # A pseudo-terminal stands in for the stick's serial port
+            self.master, self.slave = os.openpty()
+            tty.setraw(self.master)
+            self.driver = ProcessDriver(USB1Driver(os.ttyname(self.slave)))
+            self.driver.open()
+            self.evm = EventMachine(self.driver)
+            self.evm.start()
+
+        def tearDown(self):
+            self.evm.stop()
+            self.driver.close()
+            os.close(self.master)
+            os.close(self.slave)
+
+        def test_read(self):
+            # Garbage is framed away in the child
+            frames = [ChannelEventMessage(number=i).encode() for i in range(4)]
+            os.write(self.master, '\x00\x01' + ''.join(frames))
+            for i in range(4):
+                msg = self.evm.waitForMessage(ChannelEventMessage, 2)
+                self.assertEquals(msg.getChannelNumber(), i)
+            self.assertEquals(self.driver.dropped(), 0)
+
+        def test_read_without_memoryview(self):
+            # As on Python 2.6, where the child reads and feeds strings
+            self.evm.stop()
+            self.driver.close()
+            has_memoryview, process.HAS_MEMORYVIEW = \
+                process.HAS_MEMORYVIEW, False
+            try:
+                self.driver = ProcessDriver(
+                    USB1Driver(os.ttyname(self.slave)))
+                self.driver.open()
+            finally:
+                process.HAS_MEMORYVIEW = has_memoryview
+            self.evm = EventMachine(self.driver)
+            self.evm.start()
+            self.test_read()
+
+        def test_write(self):
+            raw = ChannelOpenMessage(number=3).encode()
+            self.driver.write(raw)
+            data = ''
+            while len(data) < len(raw) and \
+            select.select([self.master], [], [], 2)[0]:
+                data += os.read(self.master, 64)
+            self.assertEquals(data, raw)
+
+        def test_child_exit(self):
+            # As when the stick is unplugged and the child goes with it
+            os.kill(self.driver._process.pid, signal.SIGKILL)
+            self.driver._process.join(2)
+            stopper = threading.Thread(target=self.evm.stop)
+            stopper.start()
+            stopper.join(5)
+            self.assertFalse(stopper.isAlive())
+            self.assertTrue(isinstance(self.evm.pump_error, DriverError))
+            self.assertRaises(DriverError, self.driver.write, '\x00')
+
+        def test_open_error(self):
+            driver = ProcessDriver(USB1Driver('/nonexistent/ant-stick'))
+            self.assertRaises(DriverError, driver.open)
+            self.assertFalse(driver.isOpen())
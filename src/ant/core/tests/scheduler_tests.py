@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2011, Martín Raúl Villalba
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+##############################################################################
+
+import time
+import unittest
+
+from ant.core.node import *
+from ant.core.scheduler import *
+
+from node_tests import FakeStick
+
+
+def wait_for(condition, timeout=2.0):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            return False
+        time.sleep(0.001)
+    return True
+
+
+class ChannelSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.stick = FakeStick()
+        self.node = Node(self.stick)
+        self.node.start()
+        self.scheduler = ChannelScheduler(self.node,
+                                          self.node.networks[0].name,
+                                          self.node.channels[:2])
+        self.sensors = [Sensor(120, number) for number in range(4)]
+        for sensor in self.sensors:
+            self.scheduler.add(sensor)
+
+    def tearDown(self):
+        self.node.stop()
+
+    def serving(self):
+        return dict((slot.channel.number, slot.sensor)
+                    for slot in self.scheduler.slots
+                    if slot.state == SLOT_OPEN)
+
+    def broadcast(self, number):
+        msg = message.ChannelBroadcastDataMessage(number=number)
+        self.stick.queue.put(msg.encode())
+
+    def test_rotation(self):
+        self.scheduler.tick()
+        self.assertTrue(wait_for(lambda: len(self.serving()) == 2))
+        first = self.serving()
+        self.assertEquals(set(first.values()), set(self.sensors[:2]))
+
+        # Nothing rotates before the served sensors have been heard from
+        self.scheduler.tick()
+        self.assertEquals(self.serving(), first)
+
+        for number in first:
+            self.broadcast(number)
+        self.assertTrue(wait_for(
+            lambda: sum(s.updates for s in self.sensors) == 2))
+        self.scheduler.tick()
+        self.assertTrue(wait_for(lambda: len(self.scheduler.free) == 2))
+        self.scheduler.tick()
+        self.assertTrue(wait_for(lambda: len(self.serving()) == 2))
+        self.assertEquals(set(self.serving().values()),
+                          set(self.sensors[2:]))
+        self.assertTrue(self.node.channels[2].is_free)
+
+        for number in self.serving():
+            self.broadcast(number)
+        self.assertTrue(wait_for(
+            lambda: [s.updates for s in self.sensors] == [1, 1, 1, 1]))
+
+        # Back to the first pair, which has waited longest
+        self.scheduler.tick()
+        self.assertTrue(wait_for(lambda: len(self.scheduler.free) == 2))
+        self.scheduler.tick()
+        self.assertTrue(wait_for(lambda: len(self.serving()) == 2))
+        self.assertEquals(set(self.serving().values()),
+                          set(self.sensors[:2]))
+        for number in self.serving():
+            self.broadcast(number)
+        self.assertTrue(wait_for(
+            lambda: self.sensors[0].latency is not None and
+            self.sensors[1].latency is not None))
+        report = dict((r[0], r[1:]) for r in self.scheduler.report())
+        name = self.sensors[0].name
+        self.assertEquals(report[name][:2], (2, 0))
+        self.assertTrue(report[name][2] > 0)
+        self.assertEquals(report[name][3], report[name][2])
+
+    def test_no_rotation(self):
+        self.scheduler.remove(self.sensors[3])
+        self.scheduler.remove(self.sensors[2])
+        self.scheduler.tick()
+        self.assertTrue(wait_for(lambda: len(self.serving()) == 2))
+        first = self.serving()
+        for number in first:
+            self.broadcast(number)
+        self.assertTrue(wait_for(
+            lambda: sum(s.updates for s in self.sensors) == 2))
+        self.scheduler.tick()
+        self.assertEquals(self.serving(), first)
+        self.assertEquals(self.scheduler.free, [])
+
+    def test_search_timeout(self):
+        self.scheduler.tick()
+        self.assertTrue(wait_for(lambda: len(self.serving()) == 2))
+        first = self.serving()
+
+        # Neither sensor shows up within its search timeout
+        self.scheduler.tick(time.time() + 6)
+        self.assertTrue(wait_for(lambda: len(self.scheduler.free) == 2))
+        self.assertEquals([s.misses for s in first.values()], [1, 1])
+        self.scheduler.tick()
+        self.assertTrue(wait_for(lambda: len(self.serving()) == 2))
+        self.assertEquals(set(self.serving().values()),
+                          set(self.sensors[2:]))
+
+    def test_lost_responses(self):
+        channels = [slot.channel.number for slot in self.scheduler.slots]
+        self.stick.drops.add((channels[0], MESSAGE_CHANNEL_OPEN))
+        self.stick.drops.add((channels[1], MESSAGE_CHANNEL_UNASSIGN))
+
+        self.scheduler.tick()
+        self.assertTrue(wait_for(lambda: len(self.serving()) == 1))
+        self.assertEquals(self.scheduler.slots[0].state, SLOT_OPENING)
+        served = self.serving()[channels[1]]
+        self.scheduler.remove(served)
+        self.assertTrue(wait_for(lambda: sorted(self.node.evm.pending) == [
+            ('ack', channels[0], MESSAGE_CHANNEL_OPEN),
+            ('ack', channels[1], MESSAGE_CHANNEL_UNASSIGN)]))
+        self.assertEquals(self.scheduler.slots[1].state, SLOT_CLOSING)
+
+        # Both slots are stuck until their commands time out
+        self.scheduler.tick()
+        self.assertEquals(self.scheduler.free, [])
+        self.scheduler.tick(time.time() + 6)
+        self.assertTrue(wait_for(lambda: len(self.scheduler.free) == 1))
+        self.scheduler.tick()
+        self.assertTrue(wait_for(lambda: len(self.serving()) == 2))
+        self.assertEquals(self.node.evm.pending, {})
+
+    def test_channels_reserved(self):
+        # The node never hands out the scheduler's channels, not even
+        # while they sit unassigned between sensors
+        taken = [slot.channel for slot in self.scheduler.slots]
+        self.assertFalse(self.node.getFreeChannel() in taken)
+        self.scheduler.tick()
+        self.assertTrue(wait_for(lambda: len(self.serving()) == 2))
+        for number in self.serving():
+            self.broadcast(number)
+        self.assertTrue(wait_for(
+            lambda: sum(s.updates for s in self.sensors) == 2))
+        self.scheduler.tick()
+        self.assertTrue(wait_for(lambda: len(self.scheduler.free) == 2))
+        self.assertEquals([c.is_free for c in taken], [False, False])
+
+        config = dict(net_key=self.node.networks[0].name,
+                      ch_type=CHANNEL_TYPE_TWOWAY_RECEIVE)
+        channels = self.node.configureChannels([config] * 6)
+        self.assertEquals([c.number for c in channels], range(2, 8))
+        self.assertRaises(NodeError, self.node.getFreeChannel)
+
+    def test_data_forwarding(self):
+        received = []
+
+        class Recorder(event.EventCallback):
+            def process(self, msg):
+                received.append(msg)
+
+        self.sensors[0].registerCallback(Recorder())
+        self.scheduler.tick()
+        self.assertTrue(wait_for(lambda: len(self.serving()) == 2))
+        number = [n for n, s in self.serving().items()
+                  if s is self.sensors[0]][0]
+        self.broadcast(number)
+        self.assertTrue(wait_for(lambda: len(received) == 1))
+        self.assertTrue(isinstance(received[0],
+                                   message.ChannelBroadcastDataMessage))